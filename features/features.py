@@ -1,6 +1,8 @@
 import os
 import numpy as np
 from glob import glob
+from collections import OrderedDict
+from collections.abc import Mapping
 from schrodinger.structure import StructureReader
 from utils import basename, mp, mkdir, np_load
 
@@ -24,6 +26,62 @@ IFP = {'rd1':    {'version'           : 'rd1',
                    'pipi_t_norm_centroid_angle_cut': 45.0},
       }
 
+class PairFeatureCache:
+    """
+    Pair feature arrays read from disk, keeping the most recently used in
+    memory up to a total of max_bytes, shared by the LazyPairFeatures of
+    every feature.
+
+    Each file is read into memory and closed, so that no files are held
+    open however many are accessed. The number of cache hits and misses
+    are counted in hits and misses.
+    """
+    def __init__(self, max_bytes=2**30, delete=False):
+        self.max_bytes = max_bytes
+        self.delete = delete
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        if path in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(path)
+            return self.cache[path]
+
+        self.misses += 1
+        value = np_load(path, delete=self.delete, halt=not self.delete)
+        if value is None:
+            return value
+        self.cache[path] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return value
+
+class LazyPairFeatures(Mapping):
+    """
+    Pair features, keyed by (name1, name2), that are only read, through
+    cache, a PairFeatureCache, when accessed.
+    """
+    def __init__(self, paths, cache):
+        self.paths = paths
+        self.cache = cache
+
+    def __getitem__(self, key):
+        return self.cache.load(self.paths[key])
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
 class Features:
     """
     Organize feature computation and loading.
@@ -81,12 +139,57 @@ class Features:
         return glob(self.pv_root+'/*/*_pv.maegz')
 
     def load_features(self, pvs=None, delete=False,
-                      features=['shape','mcss','hbond','saltbridge','contact']):
+                      features=['shape','mcss','hbond','saltbridge','contact'],
+                      lazy=False, cache_bytes=2**30):
+        """
+        If lazy, pair features are loaded as LazyPairFeatures, which only read
+        each file when it is accessed, sharing a PairFeatureCache,
+        self.cache, that keeps at most cache_bytes of them in memory.
+        """
         if pvs is None:
             pvs = self.get_poseviewers()
 
         self.raw = {}
+        self._load_single_features(pvs, delete)
+        if lazy:
+            self.cache = PairFeatureCache(cache_bytes, delete)
+
+        for feature in features:
+            paths = {}
+            for i, pv1 in enumerate(pvs):
+                for pv2 in pvs[i+1:]:
+                    paths[(basename(pv1), basename(pv2))] = self.path(feature, pv=pv1, pv2=pv2)
+
+            if lazy:
+                self.raw[feature] = LazyPairFeatures(paths, self.cache)
+            else:
+                self.raw[feature] = {}
+                for key, path in paths.items():
+                    self.raw[feature][key] = np_load(path, delete=delete, halt=not delete)
+
+    def load_new_features(self, pvs, new_pvs, delete=False,
+                          features=['shape','mcss','hbond','saltbridge','contact']):
+        """
+        Load the features needed to add new_pvs to a problem already set up
+        for pvs: the single features of both and only the pair features that
+        involve one of new_pvs.
+
+        Each pair is loaded in sorted order, as computed by combind featurize.
+        """
+        self.raw = {}
+        self._load_single_features(pvs + new_pvs, delete)
 
+        for feature in features:
+            self.raw[feature] = {}
+            for i, new_pv in enumerate(new_pvs):
+                for pv in pvs + new_pvs[:i]:
+                    pv1, pv2 = sorted([pv, new_pv])
+                    path = self.path(feature, pv=pv1, pv2=pv2)
+                    name1 = basename(pv1)
+                    name2 = basename(pv2)
+                    self.raw[feature][(name1, name2)] = np_load(path, delete=delete, halt=not delete)
+
+    def _load_single_features(self, pvs, delete=False):
         self.raw['rmsd'] = {}
         for pv in pvs:
             name = basename(pv)
@@ -100,15 +203,6 @@ class Features:
             path = self.path('gscore', pv=pv)
             self.raw['gscore'][name] = np_load(path, delete=delete, halt=not delete)
 
-        for feature in features:
-            self.raw[feature] = {}
-            for i, pv1 in enumerate(pvs):
-                for pv2 in pvs[i+1:]:
-                    path = self.path(feature, pv=pv1, pv2=pv2)
-                    name1 = basename(pv1)
-                    name2 = basename(pv2)
-                    self.raw[feature][(name1, name2)] = np_load(path, delete=delete, halt=not delete)
-
     def is_single_complete(self, pvs, ifp=True):
         class IsDone:
             def __init__(self):
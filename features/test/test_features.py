@@ -0,0 +1,56 @@
+import pytest
+import os
+import numpy as np
+
+from features.features import Features, PairFeatureCache, LazyPairFeatures
+
+def open_files():
+	return len(os.listdir('/proc/self/fd'))
+
+def write_pairs(root, n, shape=(10, 10)):
+	paths = {}
+	for i in range(n):
+		path = '{}/{}.npy'.format(root, i)
+		np.save(path, np.full(shape, i, dtype=float))
+		paths[('lig{}'.format(i), 'other')] = path
+	return paths
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/fd'), reason='needs /proc')
+def test_lazy_pair_features_close_files(tmp_path):
+	paths = write_pairs(str(tmp_path), 300)
+	cache = PairFeatureCache(max_bytes=100 * 800)
+	raw = {'shape': LazyPairFeatures(paths, cache),
+	       'mcss': LazyPairFeatures(paths, cache)}
+
+	before = open_files()
+	for _ in range(2):
+		for key in paths:
+			assert raw['shape'][key][0, 0] == int(key[0][3:])
+	assert open_files() == before
+
+	# At most 100 arrays of 800 bytes are kept, shared between features.
+	assert len(cache.cache) == 100
+	assert cache.nbytes == 100 * 800
+	assert cache.misses == 600
+	assert raw['mcss'][('lig299', 'other')][0, 0] == 299
+	assert cache.hits == 1
+
+def test_load_features_lazy(tmp_path, monkeypatch):
+	monkeypatch.setenv('COMBINDHOME', str(tmp_path))
+	features = Features(str(tmp_path))
+	pvs = []
+	for i in range(3):
+		pv = '{}/docking/lig{}/lig{}_pv.maegz'.format(tmp_path, i, i)
+		os.makedirs(os.path.dirname(pv))
+		np.save(features.path('gscore', pv=pv), np.zeros(2))
+		pvs += [pv]
+	os.makedirs(str(tmp_path / 'shape'))
+	for i, pv1 in enumerate(pvs):
+		for pv2 in pvs[i+1:]:
+			np.save(features.path('shape', pv=pv1, pv2=pv2), np.ones((2, 2)))
+
+	features.load_features(pvs, features=['shape'], lazy=True, cache_bytes=32)
+	for key in features.raw['shape']:
+		assert np.all(features.raw['shape'][key] == 1)
+	assert len(features.cache.cache) == 1
+	assert features.cache.misses == 3
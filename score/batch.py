@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+import os
+import time
+from glob import glob
+from multiprocessing import Pool
+from features.features import Features
+from score.pose_prediction import PosePrediction, write_poses
+
+def read_manifest(fname):
+    """
+    Read a manifest of systems to run pose prediction on.
+
+    The manifest is a csv file with a ROOT column, the directory of each
+    system, and optionally OUT, the output file (default ROOT/poses.csv),
+    LIGANDS, space separated poseviewers (default all non-native poseviewers
+    in ROOT/docking), and XTAL, space separated crystal ligands.
+    """
+    df = pd.read_csv(fname)
+    systems = []
+    for _, row in df.iterrows():
+        root = os.path.abspath(row['ROOT'])
+        out = row['OUT'] if 'OUT' in row and isinstance(row['OUT'], str) else None
+        if out is None:
+            out = root + '/poses.csv'
+
+        if 'LIGANDS' in row and isinstance(row['LIGANDS'], str):
+            pvs = row['LIGANDS'].split()
+        else:
+            pvs = sorted(glob(root + '/docking/*/*_pv.maegz'))
+            pvs = [pv for pv in pvs if 'native' not in pv]
+
+        xtal = []
+        if 'XTAL' in row and isinstance(row['XTAL'], str):
+            xtal = row['XTAL'].split()
+        systems += [{'root': root, 'out': out, 'pvs': pvs, 'xtal': xtal}]
+    return systems
+
+def estimate_memory(features, pvs, n_features, max_poses):
+    """
+    Returns the approximate peak memory, in bytes, of pose prediction for
+    the poseviewers pvs.
+
+    The raw pair features are held as float64 for every ligand pair and all
+    docked poses, and the pair energies as float32 for at most max_poses
+    poses. Only the headers of the docking score files are read.
+    """
+    n_poses = []
+    for pv in pvs:
+        gscore = np.load(features.path('gscore', pv=pv), mmap_mode='r')
+        n_poses += [gscore.shape[0]]
+    n_poses = np.array(n_poses)
+
+    n_pairs = len(pvs)*(len(pvs)-1) // 2
+    raw = 8 * n_features * (n_poses.sum()**2 - (n_poses**2).sum()) // 2
+    pair = 4 * n_pairs * min(n_poses.max(initial=0), max_poses)**2
+    return int(raw + pair)
+
+###############################################################################
+# Worker processes for run_batch. Each worker holds the statistics, which are
+# read once in the parent process.
+
+_stats = None
+
+def _init_worker(stats):
+    global _stats
+    _stats = stats
+
+def run_system(system, params, stats=None):
+    """
+    Run pose prediction for one system and write its poses.
+
+    system (dict): As returned by read_manifest.
+    params (dict): Arguments for Features, PosePrediction and max_posterior.
+
+    Returns the wall time of each stage in seconds. If the system fails,
+    the error is printed and returned as 'error', so that the rest of a
+    batch still runs.
+    """
+    if stats is None:
+        stats = _stats
+    timing = {'ligands': len(system['pvs']), 'load': np.nan, 'setup': np.nan,
+              'optimize': np.nan, 'error': ''}
+    try:
+        _run_system(system, params, stats, timing)
+    except Exception as e:
+        print('{} failed: {!r}'.format(system['root'], e))
+        timing['error'] = repr(e)
+    return timing
+
+def _run_system(system, params, stats, timing):
+    features = params['features']
+
+    start = time.time()
+    protein = Features(system['root'], ifp_version=params['ifp_version'],
+                       shape_version=params['shape_version'],
+                       mcss_version=params['mcss_version'],
+                       max_poses=params['max_poses'])
+    protein.load_features(pvs=system['pvs'], features=features)
+    ligands = sorted(list(protein.raw['gscore'].keys()))
+    timing['ligands'] = len(ligands)
+    timing['load'] = time.time() - start
+
+    start = time.time()
+    ps = PosePrediction(ligands, protein.raw, stats, system['xtal'], features,
+                        params['max_poses'], params['alpha'], params['gc50'])
+    if params['eliminate_dead_ends']:
+        ps.eliminate_dead_ends()
+    timing['setup'] = time.time() - start
+
+    start = time.time()
+    best_poses = ps.max_posterior(params['max_iterations'], params['restart'],
+                                  1, params['seed'], params['batch_size'],
+                                  params['solver'])
+    probs = ps.get_poses_prob(best_poses)
+    timing['optimize'] = time.time() - start
+
+    write_poses(system['out'], best_poses, probs, protein.raw)
+
+def schedule(estimates, processes=1, memory=None):
+    """
+    Returns the order to run systems in, largest first, and the number of
+    processes to use, reduced, if memory (bytes) is given, so that the
+    largest systems running at once are expected to fit.
+    """
+    order = np.argsort(estimates, kind='stable')[::-1]
+    if memory is not None:
+        largest = np.cumsum(np.sort(estimates)[::-1])
+        processes = max(1, min(processes, int(np.sum(largest <= memory))))
+    return order, processes
+
+def run_batch(systems, stats, params, processes=1, memory=None):
+    """
+    Run pose prediction for many systems, sharing stats between them.
+
+    Systems are scheduled by schedule. Returns a table with the memory
+    estimate, timings and any error for each system.
+    """
+    features = Features('.')
+    estimates = [estimate_memory(features, system['pvs'], len(params['features']),
+                                 params['max_poses'])
+                 for system in systems]
+    order, processes = schedule(estimates, processes, memory)
+    for i in order:
+        print('{}: {} ligands, about {:.2f} GB'.format(
+              systems[i]['root'], len(systems[i]['pvs']), estimates[i] / 1e9))
+    print('Running {} systems on {} processes.'.format(len(systems), processes))
+
+    args = [(systems[i], params) for i in order]
+    if processes == 1:
+        timings = [run_system(system, params, stats) for system, params in args]
+    else:
+        with Pool(processes=processes, initializer=_init_worker,
+                  initargs=(stats,)) as pool:
+            timings = pool.starmap(run_system, args, chunksize=1)
+
+    table = []
+    for i, timing in zip(order, timings):
+        table += [[systems[i]['root'], timing['ligands'], estimates[i] / 1e9,
+                   timing['load'], timing['setup'], timing['optimize'],
+                   timing['load'] + timing['setup'] + timing['optimize'],
+                   timing['error']]]
+    table = pd.DataFrame(table, columns=['ROOT', 'LIGANDS', 'MEMORY_GB', 'LOAD',
+                                         'SETUP', 'OPTIMIZE', 'TOTAL', 'ERROR'])
+    return table.sort_values('ROOT')
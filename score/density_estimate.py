@@ -1,4 +1,5 @@
 import numpy as np
+import copy
 
 class DensityEstimate:
     '''
@@ -35,6 +36,10 @@ class DensityEstimate:
         self.domain = domain
         self.n_samples = 0
 
+        # Binned counts on self.grid accumulated by partial_fit.
+        self.binned = None
+        self.grid = None
+
 
     # I/O
     # File format: first line -> n_samples, sd, reflect, remaining -> x, fx
@@ -74,13 +79,15 @@ class DensityEstimate:
         '''
         return np.interp(x, self.x, self.fx)
 
-    def fit(self, X, weights=1):
+    def fit(self, X, weights=1, exact=False):
         '''
         Given an array of values X and weights weights,
         compute a density estimate with standard deviation self.sd.
         If reflect, compute densities for each flank and add
         computed densities back to the center.
         If hist, normalize so that area under the curve is equal to 
+        If exact, evaluate the kernel for every sample at every point,
+        otherwise use the much faster binned approximation, _binned_kde.
         '''
         if self.domain is None:
             self.x = np.linspace(X.min(), X.max(), self.points)
@@ -91,17 +98,94 @@ class DensityEstimate:
             return self._uniform()
 
         if self.reflect:
-            if X.max() > self.x[-1] or X.min() < self.x[0]:
-                print('Warning: Data out of domain of density estimate'
-                      ' with reflected boundary conditions. Squishing'
-                      ' data to be on specified domain.')
-                X[X > self.x[-1]] = self.x[-1]
-                X[X < self.x[0]] = self.x[0]
+            self._squish(X)
             r = self.x[-1] - self.x[0]
             self.x = np.hstack([self.x-r, self.x, self.x+r])
 
-        self._kde(X, weights)
-        
+        if exact:
+            self._kde(X, weights)
+        else:
+            self._binned_kde(X, weights)
+
+        self._fold()
+        self.n_samples = (weights*np.ones(X.shape)).sum()
+        return self
+
+    def partial_fit(self, X, weights=1):
+        '''
+        Add the values X, with weights weights, to the binned counts used by
+        the binned approximation, so that data can be fit in chunks. Call
+        finalize once all of the data has been added. Requires a domain.
+        '''
+        assert self.domain is not None, 'partial_fit requires a domain.'
+        if self.binned is None:
+            self.x = np.linspace(self.domain[0], self.domain[1], self.points)
+            if self.reflect:
+                r = self.x[-1] - self.x[0]
+                self.x = np.hstack([self.x-r, self.x, self.x+r])
+            self.grid = self._grid()
+            self.binned = np.zeros(self.grid.shape)
+            self.n_samples = 0
+
+        X = np.array(X, dtype=float).ravel()
+        if self.reflect and X.shape[0]:
+            self._squish(X, self.domain)
+        self.binned += self._bin(X, weights, self.grid)
+        self.n_samples += (weights*np.ones(X.shape)).sum()
+        return self
+
+    def finalize(self):
+        '''
+        Compute the density from the counts added by partial_fit. This gives
+        the same result as fitting all of the data at once.
+        '''
+        n_samples = self.n_samples
+        if self.binned is None or not n_samples:
+            self.x = np.linspace(self.domain[0], self.domain[1], self.points)
+            self.binned = self.grid = None
+            return self._uniform()
+
+        self.fx = self._smooth(self.binned, self.grid)
+        self.binned = self.grid = None
+        self._fold()
+        self.n_samples = n_samples
+        return self
+
+    @classmethod
+    def merge_partial(cls, des):
+        '''
+        Returns a DensityEstimate with the counts added by partial_fit to
+        each of des, which must have the same settings.
+        '''
+        out = copy.deepcopy(des[0])
+        for de in des[1:]:
+            if de.binned is None:
+                continue
+            if out.binned is None:
+                out = copy.deepcopy(de)
+                continue
+            assert np.all(de.grid == out.grid), 'Grids differ.'
+            out.binned += de.binned
+            out.n_samples += de.n_samples
+        return out
+
+    def _squish(self, X, domain=None):
+        '''
+        Clip X, in place, to domain, by default that of self.x.
+        '''
+        if domain is None:
+            domain = (self.x[0], self.x[-1])
+        if X.max() > domain[1] or X.min() < domain[0]:
+            print('Warning: Data out of domain of density estimate'
+                  ' with reflected boundary conditions. Squishing'
+                  ' data to be on specified domain.')
+            X[X > domain[1]] = domain[1]
+            X[X < domain[0]] = domain[0]
+
+    def _fold(self):
+        '''
+        Reflect the flanks into the domain, if reflect, and normalize.
+        '''
         if self.reflect:
             # left, center, right
             self.fx = (  self.fx[self.points:0:-1]
@@ -110,8 +194,6 @@ class DensityEstimate:
             self.x = self.x[self.points:2*self.points]
 
         self.fx *= (self.x.shape[0] / (self.x[-1]-self.x[0])) / self.fx.sum()
-        self.n_samples = (weights*np.ones(X.shape)).sum()
-        return self
 
     def data_loglikelihood(self, X, weights=1):
         return np.sum(np.log(self(X))*weights)
@@ -134,6 +216,56 @@ class DensityEstimate:
             self.fx += [(weights*kernel).sum()]
         self.fx = np.array(self.fx)
 
+    def _binned_kde(self, X, weights):
+        '''
+        Approximates _kde by linearly binning X onto an evenly spaced grid
+        covering self.x (see _grid) and convolving the binned weights with
+        the kernel. This is O(samples + grid points**2) rather than
+        O(samples * points).
+        '''
+        X = np.asarray(X, dtype=float).ravel()
+        if not np.any(np.diff(self.x) > 0):
+            return self._kde(X, weights)
+        grid = self._grid()
+        self.fx = self._smooth(self._bin(X, weights, grid), grid)
+
+    def _grid(self, resolution=0.1, cutoff=8):
+        '''
+        Returns an evenly spaced grid, spacing at most resolution*self.sd,
+        that includes every point of self.x if they are evenly spaced and
+        extends cutoff standard deviations beyond them.
+        '''
+        spacing = np.diff(self.x)
+        dx = spacing[spacing > 0].min()
+        h = dx / np.ceil(dx / (resolution*self.sd))
+        pad = int(np.ceil(cutoff*self.sd / h))
+        n = int(np.ceil((self.x[-1] - self.x[0]) / h - 1e-6)) + 1 + 2*pad
+        return self.x[0] + h*(np.arange(n) - pad)
+
+    def _bin(self, X, weights, grid):
+        '''
+        Returns the weights of X split between the two closest points of
+        grid. Values outside of grid are dropped.
+        '''
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), X.shape)
+        h = grid[1] - grid[0]
+        t = (X - grid[0]) / h
+        keep = (t >= 0) & (t <= len(grid)-1)
+        t, w = t[keep], weights[keep]
+        i = np.minimum(np.floor(t).astype(int), len(grid)-2)
+        frac = t - i
+        return (np.bincount(i, w*(1-frac), minlength=len(grid))
+                + np.bincount(i+1, w*frac, minlength=len(grid)))
+
+    def _smooth(self, binned, grid):
+        '''
+        Returns the density at self.x of the binned weights on grid.
+        '''
+        n = len(grid)
+        kernel = self._gauss(0, (grid[1] - grid[0])*np.arange(-(n-1), n))
+        fx = np.convolve(binned, kernel)[n-1:2*n-1]
+        return np.interp(self.x, grid, fx)
+
     def _uniform(self):
         self.n_samples = 0
         self.fx = np.ones(self.x.shape)
@@ -163,7 +295,64 @@ class DensityEstimate:
 
     @classmethod
     def merge(cls, des):
-        out = des[0]
-        for de in des[1:]:
-            out = out._average(de)
-        return out
+        '''
+        Returns the average of des weighted by their n_samples, evaluated on
+        one evenly spaced grid covering all of them, with as many points as
+        the first with samples, in a single pass. Estimates without samples
+        are ignored.
+        '''
+        _des = [de for de in des if de.n_samples]
+        if not _des:
+            return des[0]
+        if len(_des) == 1:
+            return _des[0]
+
+        x, fx, n_samples = cls.stack(_des)
+        de = cls.merge_stacked(x, fx, n_samples, reflect=_des[0].reflect)[0]
+        de.out_of_bounds = _des[0].out_of_bounds
+        return de
+
+    @classmethod
+    def stack(cls, des, points=None):
+        '''
+        Returns x, an evenly spaced grid covering all of des with points
+        points (default that of des[0]), fx (# des x points), each of des
+        evaluated on x, and the n_samples of each of des.
+        '''
+        assert len(set(de.reflect for de in des)) == 1, "Either reflect or don't."
+        if points is None:
+            points = des[0].points
+        x = np.linspace(min(de.x[0] for de in des), max(de.x[-1] for de in des),
+                        points)
+        fx = np.vstack([de(x) for de in des])
+        n_samples = np.array([de.n_samples for de in des], dtype=float)
+        return x, fx, n_samples
+
+    @classmethod
+    def merge_stacked(cls, x, fx, n_samples, subsets=None, reflect=True):
+        '''
+        Returns a DensityEstimate for each row of subsets, the average of the
+        rows of fx, densities on the grid x as returned by stack, weighted
+        by n_samples times the row of subsets. By default, all rows are
+        merged. All merges are computed with one matrix product, so many
+        subsets, e.g. leaving out each protein in turn, are cheap.
+
+        subsets (np.array, # merges x # estimates): e.g. 0/1 membership.
+        '''
+        if subsets is None:
+            subsets = np.ones((1, fx.shape[0]))
+        weights = subsets * n_samples.reshape(1, -1)
+        total = weights.sum(axis=1)
+        merged = weights @ fx
+
+        des = []
+        for _fx, _total in zip(merged, total):
+            de = DensityEstimate(points = len(x), reflect = reflect)
+            de.x = x
+            if _total:
+                de.n_samples = _total
+                de.fx = _fx / _total
+            else:
+                de._uniform()
+            des += [de]
+        return des
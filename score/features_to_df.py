@@ -1,50 +1,12 @@
 import numpy as np
+import os
 import sys
 import pandas as pd
 from features.features import Features
+from score.statistics import pair_features, read_pair_table, write_pair_table
 import click
 from glob import glob
-from utils import mp
-
-def load_protein(data, protein):
-    interactions = ['hbond',  'saltbridge', 'contact', 'shape', 'mcss']
-    features = Features(data + '/' + protein, max_poses=100)
-    features.load_features(interactions)
-    features = features.raw
-
-    # get cross-docked ligands
-    ligands = []
-    for ligand in sorted(features['gscore'].keys()):
-        if 'native' in ligand: continue
-        lig, grid = ligand.split('-to-')
-        if '_lig' in lig:
-            lig = lig.replace('_lig', '')
-        if lig != grid and 'CHEMBL' not in lig:
-            ligands += [ligand]
-
-    df = []
-    for i, ligand1 in enumerate(ligands):
-        for ligand2 in ligands[i+1:]:
-            for r1 in range(len(features['gscore'][ligand1])):
-                for r2 in range(len(features['gscore'][ligand2])):
-                    feats = [features[interaction][(ligand1, ligand2)][r1, r2]
-                             for interaction in interactions]
-                    gscore1 = features['gscore'][ligand1][r1]
-                    gscore2 = features['gscore'][ligand2][r2]
-                    rmsd1 = features['rmsd'][ligand1][r1]
-                    rmsd2 = features['rmsd'][ligand2][r2]
-                    df += [[protein,
-                            ligand1, ligand2,
-                            r1, r2,
-                            gscore1, gscore2,
-                            rmsd1, rmsd2]
-                            + feats]
-    return pd.DataFrame(df, columns=['protein',
-                                     'ligand1', 'ligand2',
-                                     'rank1', 'rank2',
-                                     'gscore1', 'gscore2',
-                                     'rmsd1', 'rmsd2']
-                                     +interactions)
+from utils import mp, mkdir
 
 def load_protein_top(data, protein, n_native, n_decoy):
     interactions = ['hbond',  'saltbridge', 'contact', 'mcss', 'shape', 'pipi', 'pi-t']
@@ -112,8 +74,11 @@ def main():
 @click.argument('data', default='/oak/stanford/groups/rondror/projects/ligand-docking/combind_bpp/combind2020_v2')
 @click.argument('output_root', default='pairs')
 def run(protein, data, output_root):
-    df = load_protein(data, protein)
-    df.to_csv('{}/{}.csv'.format(output_root, protein), index=False)
+    """
+    Write the pair table for PROTEIN to OUTPUT_ROOT/PROTEIN, streaming it
+    one chunk at a time, as read by the stages below.
+    """
+    pair_features(protein, data, output_root)
 
 @main.command()
 @click.argument('protein')
@@ -133,69 +98,99 @@ def merge(input_pattern, output_csv):
     df = pd.concat([pd.read_csv(fname) for fname in fnames])
     df.to_csv(output_csv, index=False)
 
-@main.command()
-@click.argument('input_csv')
-@click.argument('output_csv')
-def transform(input_csv, output_csv):
-    data = pd.read_csv(input_csv)
-    data = data.set_index(['protein', 'ligand1', 'ligand2'])
+###############################################################################
+# Each stage below runs on one protein at a time. Its input and output are
+# either csv files or directories with a columnar pair table, as written by
+# score.statistics.pair_features, for each protein.
+
+def _pair_keys(data):
+    return [key for key in ['protein', 'ligand1', 'ligand2'] if key in data]
+
+def transform_pairs(data):
+    data = data.copy()
+    for col in data.columns:
+        if col not in ['protein', 'ligand1', 'ligand2']:
+            data[col] = pd.to_numeric(data[col], errors='coerce')
     data['gscore1'] = -data['gscore1']
     data['gscore2'] = -data['gscore2']
     data['mcss']    = -data['mcss']
-    for col in data.columns:
-        data[col] = pd.to_numeric(data[col], errors='coerce')
 
     data['no_mcss'] = data.mcss == -float('inf')
     data.loc[data.no_mcss, 'mcss'] = 0.0
-    data.loc[(data['mcss'] < -6).to_numpy(), 'mcss'] = -6
-
-    data['no_saltbridge'] = 0
-    data.loc[data.groupby(level=[0, 1, 2]).max()['saltbridge'] == 0.5, 'no_saltbridge'] = 1
+    data.loc[data['mcss'] < -6, 'mcss'] = -6
 
-    data_rev = data.reset_index().rename(columns={'gscore1': 'gscore2', 'gscore2': 'gscore1',
-                                      'rank1': 'rank2', 'rank2': 'rank1',
-                                      'rmsd1': 'rmsd2', 'rmsd2': 'rmsd1',
-                                      'ligand1': 'ligand2', 'ligand2': 'ligand1'})
-    data_rev = data_rev.set_index(['protein', 'ligand1', 'ligand2']).sort_index()
-    data_rev = data_rev[list(data.columns)]
-    data = pd.concat([data, data_rev]).sort_index()
+    saltbridge = data.groupby(_pair_keys(data), observed=True)['saltbridge']
+    data['no_saltbridge'] = (saltbridge.transform('max') == 0.5).astype(int)
 
-    data.reset_index().to_csv(output_csv, index=False)
+    data_rev = data.rename(columns={'gscore1': 'gscore2', 'gscore2': 'gscore1',
+                                    'rank1': 'rank2', 'rank2': 'rank1',
+                                    'rmsd1': 'rmsd2', 'rmsd2': 'rmsd1',
+                                    'ligand1': 'ligand2', 'ligand2': 'ligand1'})
+    data = pd.concat([data, data_rev[list(data.columns)]], ignore_index=True)
+    return data.sort_values(_pair_keys(data), kind='stable', ignore_index=True)
 
-@main.command()
-@click.argument('input_csv')
-@click.argument('output_csv')
-def first_correct(input_csv, output_csv):
-    data = pd.read_csv(input_csv)
-    data = data.loc[data['rmsd1'] <= 2.05]
+def first_correct_pairs(data):
+    data = data.loc[data['rmsd1'] <= 2.05].copy()
     data['native'] = data['rmsd2'] <= 2.05
     data['gscore'] = data['gscore2']
-    data.reset_index().to_csv(output_csv, index=False)
+    return data.reset_index(drop=True)
 
-@main.command()
-@click.argument('input_csv')
-@click.argument('output_csv')
-def weight(input_csv, output_csv):
-    data = pd.read_csv(input_csv)
-    data = data.set_index(['protein', 'ligand1', 'ligand2'])
-    
-    # each ligand pair equal
-    w = data.loc[data['native'] == 1, 'contact'].groupby(level=[0, 1, 2]).count()
-    data.loc[data['native'] == 1, 'W_lig_pair'] = 1/w
+def weight_pairs(data):
+    data = data.copy()
+    keys = _pair_keys(data)
+    protein = keys[:-2]
 
-    w = data.loc[data['native'] != 1, 'contact'].groupby(level=[0, 1, 2]).count()
-    data.loc[data['native'] != 1, 'W_lig_pair'] = 1/w
+    # each ligand pair equal
+    w = data.groupby(keys + ['native'], observed=True)['contact'].transform('count')
+    data['W_lig_pair'] = 1/w
 
     # each ligand equal
-    w = data.reset_index().groupby(['protein', 'ligand2']).nunique()[['ligand1']]
-    w = 1/w.rename(columns={'ligand1': 'W_ligand1'})
-    data = data.join(w)
+    w = data.groupby(protein + ['ligand2'], observed=True)['ligand1'].transform('nunique')
+    data['W_ligand1'] = 1/w
 
     # each protein equal (when multiplied by above)
-    w = data.reset_index().groupby(['protein', 'ligand1']).nunique()[['ligand2']]
-    w = 1/w.rename(columns={'ligand2': 'W_ligand2'})
-    data = data.join(w)
+    w = data.groupby(protein + ['ligand1'], observed=True)['ligand2'].transform('nunique')
+    data['W_ligand2'] = 1/w
+    return data
+
+def _run(function, input, output, chunksize=10**6):
+    if not os.path.isdir(input):
+        function(pd.read_csv(input)).to_csv(output, index=False)
+        return
+
+    mkdir(output)
+    for root in sorted(glob(input + '/*/ligands.npy')):
+        root = os.path.dirname(root)
+        data = pd.concat(read_pair_table(root), ignore_index=True)
+        data = function(data)
+
+        ligands = data['ligand1'].cat.categories
+        columns = {col: (data[col].cat.codes.to_numpy()
+                         if isinstance(data[col].dtype, pd.CategoricalDtype)
+                         else data[col].to_numpy())
+                   for col in data.columns}
+        tables = ({col: values[i:i+chunksize] for col, values in columns.items()}
+                  for i in range(0, len(data), chunksize))
+        write_pair_table('{}/{}'.format(output, os.path.basename(root)),
+                         ligands, tables, chunksize)
 
-    data.reset_index().to_csv(output_csv, index=False)
+@main.command()
+@click.argument('input')
+@click.argument('output')
+def transform(input, output):
+    _run(transform_pairs, input, output)
+
+@main.command()
+@click.argument('input')
+@click.argument('output')
+def first_correct(input, output):
+    _run(first_correct_pairs, input, output)
+
+@main.command()
+@click.argument('input')
+@click.argument('output')
+def weight(input, output):
+    _run(weight_pairs, input, output)
 
-main()
+if __name__ == '__main__':
+    main()
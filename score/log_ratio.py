@@ -0,0 +1,80 @@
+import numpy as np
+
+class LogRatio:
+    '''
+    Lookup table of log(native(x) / reference(x)) for one feature.
+
+    The table is computed on an evenly spaced grid, so a value is mapped to
+    its grid interval by arithmetic rather than by the binary search in
+    np.interp. Values outside of the grid take the value at the closest end,
+    as for DensityEstimate, and nan gives nan.
+
+    Interpolating log(native / reference) rather than native and reference
+    separately gives slightly different values between the points of the
+    densities, by up to about 0.02 for the default contact statistics.
+
+    x0 (float): first grid point.
+    dx (float): grid spacing.
+    table (np.array): log density ratio at each grid point.
+    '''
+    def __init__(self, x0, dx, table):
+        self.x0 = float(x0)
+        self.dx = float(dx)
+        self.table = np.asarray(table, dtype=float)
+        self.slope = np.diff(self.table)
+
+    @classmethod
+    def from_densities(cls, native, reference, points=16384):
+        '''
+        native, reference (score.DensityEstimate)
+        points (int): number of grid points spanning the domains of both.
+        '''
+        x0 = min(native.x[0], reference.x[0])
+        x1 = max(native.x[-1], reference.x[-1])
+        x = np.linspace(x0, x1, points)
+        table = np.log(native(x)) - np.log(reference(x))
+        return cls(x0, x[1] - x[0], table)
+
+    # I/O
+    def write(self, fname):
+        np.savez(fname, x0=self.x0, dx=self.dx, table=self.table)
+
+    @classmethod
+    def read(cls, fname):
+        with np.load(fname) as data:
+            return cls(data['x0'], data['dx'], data['table'])
+
+    def __call__(self, x):
+        '''
+        Returns the log density ratio at each value of x, linearly
+        interpolated between grid points, as float64 with the shape of x.
+        '''
+        t = np.array(x, dtype=float)
+        t -= self.x0
+        t *= 1 / self.dx
+        nan = np.isnan(t)
+        if nan.any():
+            t[nan] = 0
+        np.clip(t, 0, len(self.table) - 1, out=t)
+        index = t.astype(np.intp)
+        np.minimum(index, len(self.table) - 2, out=index)
+        t -= index
+        t *= self.slope.take(index)
+        t += self.table.take(index)
+        if nan.any():
+            t[nan] = np.nan
+        return t
+
+def log_ratio(stats, x):
+    '''
+    Returns log(native(x) / reference(x)).
+
+    stats (LogRatio or {'native': score.DensityEstimate,
+                        'reference': score.DensityEstimate})
+    '''
+    if isinstance(stats, LogRatio):
+        return stats(x)
+    energy = stats['native'](x)
+    energy /= stats['reference'](x)
+    np.log(energy, out=energy)
+    return energy
@@ -0,0 +1,181 @@
+import copy
+import numpy as np
+
+class PairEnergy:
+    """
+    Pair energies between the docked poses of all pairs of ligands.
+
+    Only the blocks for ligand pairs i < j are stored, as float32. The block
+    for j, i is served as a transposed view of the block for i, j. Ligand
+    pairs without any pair features have no block and read as zeros.
+
+    Indexing mirrors the dense (# ligands x # ligands x max_poses x max_poses)
+    array that this replaces, e.g. pair[i, j, :, pose] or pair[i, j, p1, p2].
+
+    n_ligands (int)
+    max_poses (int)
+    index (np.array, # ligands x # ligands): block number for each ligand
+        pair, -1 if the pair has no block.
+    blocks (np.array, # blocks x max_poses x max_poses)
+    """
+    def __init__(self, n_ligands, max_poses, pairs, dtype=np.float32):
+        '''
+        pairs ([(int, int), ]): ligand pairs, i < j, for which to store blocks.
+        '''
+        self.n_ligands = n_ligands
+        self.max_poses = max_poses
+        self.index = -np.ones((n_ligands, n_ligands), dtype=int)
+        for k, (i, j) in enumerate(pairs):
+            assert i < j, (i, j)
+            self.index[i, j] = k
+            self.index[j, i] = k
+        self.blocks = np.zeros((len(pairs), max_poses, max_poses), dtype=dtype)
+
+        self._zero = np.zeros((max_poses, max_poses), dtype=dtype)
+        self._zero.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes
+
+    def memmap(self, fname):
+        '''
+        Write the blocks to fname and return a copy of self backed by a
+        read-only memory map of that file.
+
+        The copy is pickled by file name, so worker processes map the same
+        pages rather than each receiving a copy of the blocks.
+        '''
+        np.save(fname, self.blocks)
+        pair = copy.copy(self)
+        pair.blocks = np.load(fname, mmap_mode='r')
+        return pair
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.blocks, np.memmap):
+            state['blocks'] = self.blocks.filename
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.blocks, str):
+            self.blocks = np.load(self.blocks, mmap_mode='r')
+
+    def __contains__(self, pair):
+        i, j = pair
+        return self.index[i, j] >= 0
+
+    def block(self, i, j):
+        '''
+        Returns the (max_poses x max_poses) energies between the poses of
+        ligand i (rows) and ligand j (columns).
+        '''
+        k = self.index[i, j]
+        if k < 0:
+            return self._zero
+        if i < j:
+            return self.blocks[k]
+        return self.blocks[k].T
+
+    def __getitem__(self, key):
+        i, j = key[:2]
+        return self.block(i, j)[key[2:]]
+
+    def add(self, i, j, energy):
+        '''
+        Add energy, an array of at most (max_poses x max_poses) with rows
+        corresponding to poses of ligand i, to the block for i, j.
+        '''
+        assert i != j
+        if i > j:
+            i, j, energy = j, i, energy.T
+        k = self.index[i, j]
+        assert k >= 0, 'No block for ligands {} and {}.'.format(i, j)
+        energy = energy[:self.max_poses, :self.max_poses]
+        self.blocks[k, :energy.shape[0], :energy.shape[1]] += energy
+
+    def columns(self, j, pose):
+        '''
+        Returns the (n_ligands x max_poses) energies between every pose of
+        each ligand and the given pose of ligand j. The row for j is zero.
+
+        pose can also be an array of poses, in which case the result has
+        shape pose.shape + (n_ligands, max_poses).
+        '''
+        pose = np.asarray(pose)
+        poses = pose.reshape(-1, 1)
+        out = np.zeros((poses.shape[0], self.n_ligands, self.max_poses),
+                       dtype=self.blocks.dtype)
+        index = self.index[:, j]
+
+        # Blocks for i < j are stored as (i, j), so take a column, and blocks
+        # for i > j are stored as (j, i), so take a row.
+        below = np.nonzero(index[:j] >= 0)[0]
+        above = j+1 + np.nonzero(index[j+1:] >= 0)[0]
+        out[:, below] = self.blocks[index[below], :, poses]
+        out[:, above] = self.blocks[index[above], poses, :]
+        return out.reshape(pose.shape + out.shape[1:])
+
+    def to_poses(self, i, poses):
+        '''
+        Returns the (n_ligands x max_poses) energies between every pose of
+        ligand i and pose poses[j] of each ligand j. The row for i is zero.
+        '''
+        out = np.zeros((self.n_ligands, self.max_poses), dtype=self.blocks.dtype)
+        index = self.index[i]
+
+        # Blocks for i < j are stored as (i, j), so take a column, and blocks
+        # for j < i are stored as (j, i), so take a row.
+        below = np.nonzero(index[:i] >= 0)[0]
+        above = i+1 + np.nonzero(index[i+1:] >= 0)[0]
+        out[below] = self.blocks[index[below], poses[below], :]
+        out[above] = self.blocks[index[above], :, poses[above]]
+        return out
+
+    def pose_matrix(self, ligands, poses):
+        '''
+        Returns the (len(ligands) x len(ligands)) energies between pose
+        poses[a] of ligand ligands[a] and pose poses[b] of ligand ligands[b].
+        The diagonal, and ligand pairs without a block, are zero.
+        '''
+        ligands, poses = np.asarray(ligands), np.asarray(poses)
+        i, j = ligands.reshape(-1, 1), ligands.reshape(1, -1)
+        p1, p2 = poses.reshape(-1, 1), poses.reshape(1, -1)
+        index = self.index[i, j]
+        if not self.blocks.shape[0]:
+            return np.zeros(index.shape, dtype=self.blocks.dtype)
+
+        out = np.where(i < j,
+                       self.blocks[np.maximum(index, 0), p1, p2],
+                       self.blocks[np.maximum(index, 0), p2, p1])
+        out[index < 0] = 0
+        return out
+
+    def compact(self, pairs):
+        '''
+        Keep only the blocks for the ligand pairs pairs, i < j, given in the
+        order their blocks are stored, moving them down within blocks and
+        shrinking it in place rather than copying them to a new array.
+        '''
+        index = -np.ones_like(self.index)
+        for k, (i, j) in enumerate(pairs):
+            old = self.index[i, j]
+            assert old >= k, (i, j)
+            if old != k:
+                self.blocks[k] = self.blocks[old]
+            index[i, j] = k
+            index[j, i] = k
+        self.index = index
+        self.blocks.resize((len(pairs),) + self.blocks.shape[1:], refcheck=False)
+
+    def subset(self, ligands):
+        '''
+        Returns a PairEnergy for the ligands numbered ligands, an increasing
+        array, that shares the blocks of self rather than copying them.
+        '''
+        assert np.all(np.diff(ligands) > 0)
+        pair = copy.copy(self)
+        pair.n_ligands = len(ligands)
+        pair.index = self.index[np.ix_(ligands, ligands)]
+        return pair
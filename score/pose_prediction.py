@@ -1,5 +1,14 @@
 import numpy as np
 import os
+import copy
+import pickle
+import tempfile
+import time
+import pandas as pd
+from collections import ChainMap
+from multiprocessing import Pool
+from score.pair_energy import PairEnergy
+from score.log_ratio import log_ratio
 
 def pad(x, shape1, shape2=0, C=1000):
     if len(x.shape) == 1:
@@ -22,195 +31,943 @@ class PosePrediction:
 
     ligands ([containers.Ligand,])
     ligand_names ([str, ])
+    ligand_index ({str: int}): Position of each ligand in ligands.
     xtal (set([str,]))
 
     mcss (mcss.MCSSController)
     shape (mcss.ShapeController)
 
+    gscore (np.array, # ligands x max_poses): Docking scores, padded with
+        1000.
     single (np.array, # ligands x 2)
-    pair (np.array, # ligands x # ligands x max_poses x max_poses)
+    pair (score.PairEnergy, # ligands x # ligands x max_poses x max_poses)
     corr (np.array, # ligands x # ligands)
+    feature_blocks ({feature: np.array}): Pair energy blocks for each
+        feature alone, laid out as pair.blocks, cached by configure.
+
+    q (np.array, # ligands): Probability that each ligand's pose is correct
+        from the last call to message_passing during optimization, used to
+        warm start the next call. nan if not yet computed.
+    message_passing_calls (int)
+    message_passing_iterations (int): Total iterations of message_passing.
+
+    n_poses (np.array, # ligands): Number of actual poses for each ligand.
+    pose_map (np.array, # ligands x max_poses): Docked pose number for each
+        pose considered, -1 for padding. This is the identity until poses are
+        removed by eliminate_dead_ends.
+    pose_limit (int): max_poses requested, which bounds max_poses when
+        ligands are added.
+    best_poses (np.array, # ligands): Docked pose numbers found by the last
+        call to max_posterior, None before then.
     """
     def __init__(self, ligands, raw, stats, xtal,
-                 features, max_poses, alpha, gc50):
+                 features, max_poses, alpha, gc50, keep_feature_blocks=False):
+        """
+        If keep_feature_blocks, the pair energies for each feature are also
+        kept in feature_blocks, for configure, while the raw features are
+        read, rather than computed again on the first call to configure.
+        """
         self.ligands = ligands
+        self.ligand_index = {ligand: i for i, ligand in enumerate(ligands)}
         self.raw = raw
         self.stats = stats
         self.xtal = xtal
         self.features = features
+        self.pose_limit = max_poses
         self.max_poses = self._get_max_poses(max_poses)
         self.alpha = float(alpha)
         self.gc50 = float(gc50)
 
+        self.n_poses = np.array([min(len(self.raw['gscore'][ligand]), self.max_poses)
+                                 for ligand in self.ligands])
+        self.pose_map = np.tile(np.arange(self.max_poses), (len(self.ligands), 1))
+        self.pose_map[self.pose_map >= self.n_poses.reshape(-1, 1)] = -1
+
+        self.gscore = self._get_gscore()
         self.single = self._get_single()
-        self.pair = self._get_pair()
+        self.feature_blocks = None
+        if keep_feature_blocks:
+            self.pair, self.feature_blocks = self._get_pair_by_feature()
+        else:
+            self.pair = self._get_pair()
         self.corr = self._get_corr()
 
+        self.q = np.full(len(self.ligands), np.nan)
+        self.message_passing_calls = 0
+        self.message_passing_iterations = 0
+        self.best_poses = None
+
+    def __getstate__(self):
+        # The raw features are only needed to set up the problem, so don't
+        # send them to worker processes.
+        state = self.__dict__.copy()
+        state['raw'] = None
+        state['feature_blocks'] = None
+        return state
+
+    def write(self, fname):
+        """
+        Save the problem, including the pair energies and best_poses, so that
+        ligands can later be added with add_ligands. The raw features are not
+        saved.
+        """
+        with open(fname, 'wb') as fp:
+            pickle.dump(self, fp, protocol=4)
+
+    @classmethod
+    def read(cls, fname):
+        with open(fname, 'rb') as fp:
+            ps = pickle.load(fp)
+        assert isinstance(ps, cls), fname
+        return ps
+
     def _get_max_poses(self, max_poses):
         actual = max(len(x) for x in self.raw['gscore'].values())
         return min(max_poses, actual)
 
-    def _get_single(self):
-        single = []
-        for ligand in self.ligands:
-            gscore = self.raw['gscore'][ligand]
-            if ligand in self.xtal:
-                gscore[:] = -20.0
-            single += [gscore]
+    def _get_gscore(self):
+        gscore = [pad(self.raw['gscore'][ligand], self.max_poses)
+                  for ligand in self.ligands]
+        return np.vstack(gscore)
 
-        single = [pad(x, self.max_poses) for x in single]
-        single = np.vstack(single)
+    def _get_single(self):
+        # All poses of crystal ligands are given the score of a correct pose.
+        xtal = np.array([ligand in self.xtal for ligand in self.ligands])
+        single = np.where(xtal.reshape(-1, 1) & (self.pose_map >= 0),
+                          -20.0, self.gscore)
 
         if self.gc50 != float('inf'):
             single -= self.gc50
         single = -self.alpha*single
         return single
 
-    def _get_pair(self):
-        pair = np.zeros((len(self.ligands), len(self.ligands),
-                         self.max_poses, self.max_poses))
-        for i, ligand1 in enumerate(self.ligands):
-            for j, ligand2 in enumerate(self.ligands[i+1:]):
-                j += i+1
-                for feature in self.features:
-                    stats = self.stats[feature]
-                    raw = self.raw[feature][(ligand1, ligand2)]
-
-                    if raw[0, 0] == float('inf'):
-                        assert np.all(raw == float('inf'))
-                        continue
-
-                    energy = np.log(stats['native'](raw)) - np.log(stats['reference'](raw))
-                    energy = pad(energy, self.max_poses, self.max_poses)
-                    pair[i, j] += energy
-                    pair[j, i] += energy.T
+    def _raw_pair(self, feature, i, j):
+        """
+        Returns the raw feature with rows corresponding to poses of ligand i,
+        whichever order the ligand pair is stored in.
+        """
+        ligand1, ligand2 = self.ligands[i], self.ligands[j]
+        if (ligand1, ligand2) in self.raw[feature]:
+            return self.raw[feature][(ligand1, ligand2)]
+        return self.raw[feature][(ligand2, ligand1)].T
+
+    def _pair_energies(self, pairs):
+        """
+        Yields i, j, {feature: energy} for each ligand pair i, j in pairs
+        that has any pair features, where energy is the log density ratio of
+        the raw feature. Each raw feature is read once, and features that a
+        ligand pair lacks, stored as inf, are left out.
+        """
+        for i, j in pairs:
+            energies = {}
+            for feature in self.features:
+                raw = self._raw_pair(feature, i, j)
+                if raw[0, 0] == float('inf'):
+                    assert np.all(raw == float('inf'))
+                    continue
+                raw = raw[:self.max_poses, :self.max_poses]
+                energies[feature] = log_ratio(self.stats[feature], raw)
+            if energies:
+                yield i, j, energies
+
+    def _add_pair_energies(self, pair, pairs, feature_pairs=None):
+        """
+        Add the energies of the ligand pairs pairs to their blocks in pair,
+        and, if given, those of each feature to {feature: PairEnergy}
+        feature_pairs, as they are computed. Returns the pairs that have any
+        pair features.
+        """
+        found = []
+        for i, j, energies in self._pair_energies(pairs):
+            for feature, energy in energies.items():
+                pair.add(i, j, energy)
+                if feature_pairs is not None:
+                    feature_pairs[feature].add(i, j, energy)
+            found += [(i, j)]
+        return found
+
+    def _get_pair(self, pairs=None):
+        """
+        Returns a PairEnergy with a block for each ligand pair in pairs, by
+        default all pairs, that has any pair features.
+
+        Blocks are allocated for every pair, filled in place, and those of
+        pairs without features dropped afterwards, so the blocks are held in
+        a single buffer.
+        """
+        n = len(self.ligands)
+        if pairs is None:
+            pairs = [(i, j) for i in range(n) for j in range(i+1, n)]
+
+        pair = PairEnergy(n, self.max_poses, pairs)
+        pair.compact(self._add_pair_energies(pair, pairs))
         return pair
 
+    def _get_feature_blocks(self):
+        """
+        Returns {feature: np.array}, the pair energy blocks for each feature
+        alone, laid out as self.pair.blocks.
+        """
+        feature_pairs = {}
+        for feature in self.features:
+            feature_pairs[feature] = copy.copy(self.pair)
+            feature_pairs[feature].blocks = np.zeros_like(self.pair.blocks)
+
+        pairs = zip(*np.nonzero(np.triu(self.pair.index >= 0)))
+        for i, j, energies in self._pair_energies(pairs):
+            for feature, energy in energies.items():
+                feature_pairs[feature].add(i, j, energy)
+        return {feature: pair.blocks for feature, pair in feature_pairs.items()}
+
+    def _get_pair_by_feature(self):
+        """
+        Returns the PairEnergy for all ligand pairs, as _get_pair, and
+        {feature: np.array}, the blocks for each feature alone, which it is
+        the sum of. Each raw feature is read once and all blocks are filled
+        in place, as in _get_pair.
+        """
+        n = len(self.ligands)
+        pairs = [(i, j) for i in range(n) for j in range(i+1, n)]
+        pair = PairEnergy(n, self.max_poses, pairs)
+        feature_pairs = {feature: PairEnergy(n, self.max_poses, pairs)
+                         for feature in self.features}
+
+        found = self._add_pair_energies(pair, pairs, feature_pairs)
+        pair.compact(found)
+        for feature_pair in feature_pairs.values():
+            feature_pair.compact(found)
+        return pair, {feature: feature_pair.blocks
+                      for feature, feature_pair in feature_pairs.items()}
+
+    def configure(self, features=None, alpha=None, gc50=None):
+        """
+        Returns a copy of this problem using a subset of the features or a
+        different alpha or gc50, e.g. for a hyperparameter sweep.
+
+        The pair energies for each feature are kept in feature_blocks, from
+        construction if keep_feature_blocks, else from the first call, so
+        configurations only sum cached blocks. Ligand pairs with no features
+        in the subset keep a zero block. Must be called before
+        eliminate_dead_ends.
+        """
+        assert self._unrestricted(), \
+            'configure must be called before eliminate_dead_ends.'
+        if features is None:
+            features = self.features
+        assert set(features) <= set(self.features), features
+        if self.feature_blocks is None:
+            self.feature_blocks = self._get_feature_blocks()
+
+        ps = copy.copy(self)
+        ps.features = list(features)
+        if alpha is not None:
+            ps.alpha = float(alpha)
+        if gc50 is not None:
+            ps.gc50 = float(gc50)
+        ps.single = ps._get_single()
+
+        ps.pair = copy.copy(self.pair)
+        ps.pair.blocks = np.zeros_like(self.pair.blocks)
+        for feature in ps.features:
+            ps.pair.blocks += self.feature_blocks[feature]
+
+        ps.q = np.full(len(ps.ligands), np.nan)
+        ps.message_passing_calls = 0
+        ps.message_passing_iterations = 0
+        return ps
+
+    def add_ligands(self, ligands, raw):
+        """
+        Add ligands to the problem, computing only the pair energies between
+        them and the other ligands.
+
+        ligands ([str, ]): New ligands, appended to self.ligands.
+        raw: As for the constructor, with at least the docking scores of the
+            new ligands and the pair features between each new ligand and
+            every other ligand, keyed in either order.
+
+        The new ligands start from their top docked pose in best_poses, so
+        that max_posterior(warm_start=True) continues from the previous
+        solution. Must be called before eliminate_dead_ends.
+        """
+        assert self._unrestricted(), \
+            'add_ligands must be called before eliminate_dead_ends.'
+        assert not set(ligands) & set(self.ligands), ligands
+        if self.raw is None:
+            self.raw = {}
+        for key, value in raw.items():
+            # Chain rather than update, so lazily loaded features stay lazy.
+            self.raw[key] = ChainMap(value, self.raw[key]) if key in self.raw else value
+
+        n = len(self.ligands)
+        self.ligands = self.ligands + list(ligands)
+        self.ligand_index = {ligand: i for i, ligand in enumerate(self.ligands)}
+
+        old_max_poses = self.max_poses
+        actual = max(len(self.raw['gscore'][ligand]) for ligand in ligands)
+        self.max_poses = min(self.pose_limit, max(self.max_poses, actual))
+
+        # Keep the blocks already computed and add those for the new ligands.
+        old_pairs = list(zip(*np.nonzero(np.triu(self.pair.index >= 0))))
+        new_pairs = [(i, j) for j in range(n, len(self.ligands)) for i in range(j)]
+        pair = PairEnergy(len(self.ligands), self.max_poses, old_pairs + new_pairs)
+        if old_pairs:
+            i, j = np.array(old_pairs).T
+            pair.blocks[:len(old_pairs), :old_max_poses, :old_max_poses] = \
+                self.pair.blocks[self.pair.index[i, j]]
+        new_pairs = self._add_pair_energies(pair, new_pairs)
+        pair.compact(old_pairs + new_pairs)
+        self.pair = pair
+
+        n_poses = [min(len(self.raw['gscore'][ligand]), self.max_poses)
+                   for ligand in ligands]
+        self.n_poses = np.hstack([self.n_poses, n_poses]).astype(int)
+        self.pose_map = np.tile(np.arange(self.max_poses), (len(self.ligands), 1))
+        self.pose_map[self.pose_map >= self.n_poses.reshape(-1, 1)] = -1
+
+        gscore = np.full((len(self.ligands), self.max_poses), 1000.0)
+        gscore[:n, :old_max_poses] = self.gscore
+        for i, ligand in enumerate(ligands):
+            gscore[n+i] = pad(self.raw['gscore'][ligand], self.max_poses)
+        self.gscore = gscore
+        self.single = self._get_single()
+        self.corr = self._get_corr()
+
+        self.q = np.hstack([self.q, np.full(len(ligands), np.nan)])
+        self.feature_blocks = None
+        if self.best_poses is not None:
+            self.best_poses = np.hstack([self.best_poses,
+                                         np.zeros(len(ligands), dtype=int)])
+
+    def _unrestricted(self):
+        """
+        Returns whether no poses have been removed by eliminate_dead_ends.
+        """
+        return np.all(self.pose_map[self.pose_map >= 0]
+                      == np.nonzero(self.pose_map >= 0)[1])
+
     def _get_corr(self):
         corr = np.ones((len(self.ligands), len(self.ligands)))
         np.fill_diagonal(corr, 1)
         return corr
 
+    def eliminate_dead_ends(self, max_iterations=100, chunk_size=256):
+        """
+        Remove poses that cannot be part of the maximum posterior assignment.
+
+        A pose r of a ligand is a dead end if its score, with every other
+        ligand in its most favorable remaining pose for r, is lower than the
+        score of some other pose s, with every other ligand in its least
+        favorable remaining pose for s. Removing poses can make further poses
+        dead ends, so this is repeated until no more poses are removed.
+
+        The problem is then restricted to the remaining poses. Pose numbers
+        passed to and returned by max_posterior and get_poses_prob still
+        refer to the docked poses; see pose_map.
+
+        Returns the number of poses removed for each ligand.
+        """
+        alive = self.pose_map >= 0
+        n_alive = alive.sum(axis=1)
+        pairs = np.array(np.nonzero(np.triu(self.pair.index >= 0))).T
+        single = (len(self.ligands)-1)*self.single
+
+        for _ in range(max_iterations):
+            best = single.copy()
+            worst = single.copy()
+            for start in range(0, len(pairs), chunk_size):
+                i, j = pairs[start:start+chunk_size].T
+                blocks = self.pair.blocks[self.pair.index[i, j]]
+                alive_i = alive[i].reshape(-1, self.max_poses, 1)
+                alive_j = alive[j].reshape(-1, 1, self.max_poses)
+
+                np.add.at(best, i, np.where(alive_j, blocks, -np.inf).max(axis=2))
+                np.add.at(best, j, np.where(alive_i, blocks, -np.inf).max(axis=1))
+                np.add.at(worst, i, np.where(alive_j, blocks, np.inf).min(axis=2))
+                np.add.at(worst, j, np.where(alive_i, blocks, np.inf).min(axis=1))
+
+            worst[~alive] = -np.inf
+            alive &= best >= worst.max(axis=1, keepdims=True) - 1e-6
+            if np.all(alive.sum(axis=1) == n_alive):
+                break
+            n_alive = alive.sum(axis=1)
+
+        eliminated = self.n_poses - alive.sum(axis=1)
+        self._restrict_poses(alive)
+        return dict(zip(self.ligands, eliminated))
+
+    def _restrict_poses(self, alive):
+        """
+        Restrict the problem to the poses marked in alive.
+        """
+        max_poses = alive.sum(axis=1).max()
+        poses = [np.nonzero(_alive)[0] for _alive in alive]
+
+        single = np.full((len(self.ligands), max_poses), -np.inf)
+        gscore = np.full((len(self.ligands), max_poses), 1000.0)
+        pose_map = -np.ones((len(self.ligands), max_poses), dtype=int)
+        for lig, _poses in enumerate(poses):
+            single[lig, :len(_poses)] = self.single[lig, _poses]
+            gscore[lig, :len(_poses)] = self.gscore[lig, _poses]
+            pose_map[lig, :len(_poses)] = self.pose_map[lig, _poses]
+
+        pairs = list(zip(*np.nonzero(np.triu(self.pair.index >= 0))))
+        pair = PairEnergy(len(self.ligands), max_poses, pairs)
+        for i, j in pairs:
+            pair.add(i, j, self.pair.block(i, j)[np.ix_(poses[i], poses[j])])
+
+        self.max_poses = max_poses
+        self.n_poses = np.array([len(_poses) for _poses in poses])
+        self.single, self.pair, self.pose_map = single, pair, pose_map
+        self.gscore = gscore
+        self.feature_blocks = None
+
+    def subproblem(self, ligands, xtal=None):
+        """
+        Returns a PosePrediction for a subset of the ligands that shares this
+        one's pair energies, so that many sub-problems, e.g. leave-one-out or
+        a query with a few helpers, can be solved from one loaded problem.
+
+        ligands ([str, ]): Ligands to include. They are kept in the order
+            of self.ligands.
+        xtal (set([str,])): Ligands for which every pose is treated as
+            correct, as for the constructor. Defaults to self.xtal.
+
+        Poses removed by eliminate_dead_ends stay removed, so for exact
+        results call it on the sub-problem rather than on this one.
+        """
+        index = np.array(sorted(self.ligand_index[ligand] for ligand in ligands),
+                         dtype=int)
+        sub = copy.copy(self)
+        sub.ligands = [self.ligands[i] for i in index]
+        sub.ligand_index = {ligand: i for i, ligand in enumerate(sub.ligands)}
+        if xtal is not None:
+            sub.xtal = xtal
+
+        sub.n_poses = self.n_poses[index]
+        sub.pose_map = self.pose_map[index]
+        sub.gscore = self.gscore[index]
+        sub.single = sub._get_single()
+        sub.single[sub.pose_map < 0] = self.single[index][sub.pose_map < 0]
+        sub.pair = self.pair.subset(index)
+        sub.corr = self.corr[np.ix_(index, index)]
+
+        if self.best_poses is not None:
+            sub.best_poses = self.best_poses[index]
+        sub.q = np.full(len(sub.ligands), np.nan)
+        sub.message_passing_calls = 0
+        sub.message_passing_iterations = 0
+        return sub
+
+    def _docked_poses(self, iposes):
+        """
+        Convert iposes (np.array, # ligands) from pose numbers used here to
+        {ligand_name: docked pose number}.
+        """
+        return {lig: self.pose_map[i, pose]
+                for i, (lig, pose) in enumerate(zip(self.ligands, iposes))}
+
+    def _considered_poses(self, poses):
+        """
+        Convert {ligand_name: pose} from docked pose numbers to the indices
+        of the ligands and an array of pose numbers used here, ordered as in
+        self.ligands.
+        """
+        ligands = np.array(sorted(self.ligand_index[lig] for lig in poses), dtype=int)
+        iposes = np.zeros(len(self.ligands), dtype=int)
+        for i in ligands:
+            lig = self.ligands[i]
+            _pose = np.nonzero(self.pose_map[i] == poses[lig])[0]
+            assert len(_pose), 'Pose {} of {} was eliminated.'.format(poses[lig], lig)
+            iposes[i] = _pose[0]
+        return ligands, iposes
+
+    def _iposes(self, poses):
+        """
+        Convert {ligand_name: pose} for all ligands to an array of pose
+        numbers ordered as in self.ligands.
+        """
+        return np.array([poses[lig] for lig in self.ligands], dtype=int)
+
     ###########################################################################
-    def max_posterior(self, max_iterations, restart):
+    def max_posterior(self, max_iterations, restart, processes=1, seed=0,
+                      batch_size=1, solver='greedy', warm_start=False,
+                      rediscoveries=None, stop_probability=None, log=None,
+                      min_restarts=10):
         """
         max_iterations (int): Maximum number of iterations to attempt before exiting.
         restart (int): Number of times to run the optimization
+        processes (int): Number of worker processes to spread restarts over.
+        seed (int): Seed from which each restart's own seed is derived, so
+            results do not depend on the number of processes.
+        batch_size (int): Number of restarts to advance together with
+            optimize_poses_batch. Only used when gc50 is inf.
+        solver (str): One of SOLVERS. 'greedy' runs restarts of coordinate
+            ascent, the others run a single round of message passing (see
+            max_product) and ignore restart, processes and batch_size.
+        warm_start (bool): Start the first restart from best_poses rather than
+            the top docked poses.
+        rediscoveries (int): Stop once the best poses have been found again
+            this many times.
+        stop_probability (float): Stop once the estimated probability that
+            another restart finds poses not seen yet, and so could improve on
+            the best, is below this. This is the Good-Turing estimate, the
+            fraction of restarts that found poses no other restart found.
+        min_restarts (int): Do not stop on stop_probability before this many
+            restarts, nor before the best poses have been found twice, as the
+            estimate is meaningless after a few restarts that agree.
+        log (str): csv file to write the iterations, score and wall time of
+            each restart to. The same records are kept in self.restart_log.
+            A message passing solver, or a problem with one ligand, is
+            recorded as a single restart.
+
+        Restarts are considered in order, so where they stop does not depend
+        on processes. Each restart's wall time is that of its batch divided by
+        batch_size.
+
+        After a message passing solver, self.bound holds an upper bound on
+        the log posterior of any set of poses.
         """
+        assert solver in SOLVERS, solver
+        self.bound = None
+        self.restart_log = []
         if len(self.ligands) == 1:
-            return {self.ligands[0]: 0}
+            iposes = np.zeros(1, dtype=int)
+            self.restart_log = [{'run': 0, 'score': self._log_posterior(iposes),
+                                 'iterations': 0, 'time': 0.0,
+                                 'best_score': self._log_posterior(iposes)}]
+            self._write_restart_log(log)
+            self.best_poses = self.pose_map[:, 0].copy()
+            return {self.ligands[0]: self.pose_map[0, 0]}
+
+        if solver != 'greedy':
+            start_time = time.time()
+            rho = 1.0 if solver == 'max-product' else 2 / len(self.ligands)
+            iposes, self.bound = self.max_product(max_iterations, rho=rho)
+            rng = np.random.RandomState(np.random.MT19937(np.random.SeedSequence(seed)))
+            iposes, iterations = self.optimize_poses_batch(iposes.reshape(1, -1), max_iterations, rng)
+            iposes = iposes[0]
+            score = self._log_posterior(iposes)
+            print(dict(zip(self.ligands, iposes)))
+            print('{}, score {}, bound {}'.format(solver, score, self.bound))
+            self.restart_log = [{'run': 0, 'score': score,
+                                 'iterations': int(iterations[0]),
+                                 'time': time.time() - start_time,
+                                 'best_score': score}]
+            self._write_restart_log(log)
+            self.best_poses = self.pose_map[np.arange(len(self.ligands)), iposes]
+            return self._docked_poses(iposes)
+
+        seeds = np.random.SeedSequence(seed).spawn(restart)
+        warm_start = warm_start and self.best_poses is not None
+        args = [(i, max_iterations, seeds[i:i+batch_size], warm_start)
+                for i in range(0, restart, batch_size)]
+        stop = (rediscoveries, stop_probability, min_restarts)
+        if processes == 1:
+            results = (self._restarts(*_args) for _args in args)
+            best_poses = self._best_restart(results, *stop)
+        else:
+            # Leaving the pool terminates any batches still running.
+            with tempfile.TemporaryDirectory() as tmp:
+                worker = copy.copy(self)
+                worker.pair = self.pair.memmap(tmp + '/pair.npy')
+                with Pool(processes=processes, initializer=_init_worker,
+                          initargs=(worker,)) as pool:
+                    results = pool.imap(_restarts, args)
+                    best_poses = self._best_restart(results, *stop)
+
+        self._write_restart_log(log)
+        self.best_poses = self.pose_map[np.arange(len(self.ligands)), best_poses]
+        return self._docked_poses(best_poses)
+
+    def _write_restart_log(self, log):
+        if log is not None:
+            pd.DataFrame(self.restart_log).to_csv(log, index=False)
+
+    def _best_restart(self, results, rediscoveries=None, stop_probability=None,
+                      min_restarts=10):
+        """
+        Returns the best poses from results, batches of restarts in order,
+        stopping early as described in max_posterior. The restarts
+        considered are recorded in self.restart_log.
+        """
+        self.restart_log = []
+        found = {}
         best_score, best_poses = -float('inf'), None
-        for i in range(restart):
-            if i == 0:
-                poses = {lig: 0 for lig in self.ligands}
-            else:
-                poses = {lig: np.random.randint(self.max_poses)
-                         for lig in self.ligands}
-
-            poses = self.optimize_poses(poses, max_iterations)
-            score = self.log_posterior(poses)
-            if score > best_score:
-                best_score = score
-                best_poses = poses.copy()
-
-            print(poses)
-            print('run {}, score {}'.format(i, score))
-        q = self.get_prob(self.poses_to_iposes(poses))
-        C = self.correlations(self.corr, q)
+        for _results in results:
+            for iposes, score, iterations, seconds in _results:
+                key = iposes.tobytes()
+                found[key] = found.get(key, 0) + 1
+                if score > best_score:
+                    best_score = score
+                    best_poses = iposes.copy()
+                    print(dict(zip(self.ligands, iposes)))
+
+                i = len(self.restart_log)
+                print('run {}, score {}'.format(i, score))
+                self.restart_log += [{'run': i, 'score': score,
+                                      'iterations': iterations, 'time': seconds,
+                                      'best_score': best_score}]
+
+                n = len(self.restart_log)
+                if (rediscoveries is not None
+                        and found[best_poses.tobytes()] > rediscoveries):
+                    print('Found the best poses {} times.'.format(rediscoveries+1))
+                    return best_poses
+
+                unseen = sum(count == 1 for count in found.values()) / n
+                if (stop_probability is not None and n >= min_restarts
+                        and found[best_poses.tobytes()] > 1
+                        and unseen < stop_probability):
+                    print('Estimated probability of new poses {}.'.format(unseen))
+                    return best_poses
         return best_poses
 
-    def optimize_poses(self, poses, max_iterations):
+    def _restarts(self, start, max_iterations, seeds, warm_start=False):
+        """
+        Run restarts start, start+1, ... each with its own random state.
+
+        When gc50 is inf and there are several seeds, the restarts are
+        optimized together and the ligand order for each sweep is drawn from
+        the first restart's random state.
+
+        Returns [(poses, log posterior, iterations, wall time), ].
+        """
+        rngs = [np.random.RandomState(np.random.MT19937(seed)) for seed in seeds]
+        iposes = np.array([self._initial_poses(start+i, rng, warm_start)
+                           for i, rng in enumerate(rngs)])
+
+        start_time = time.time()
+        if len(seeds) > 1 and self.gc50 == float('inf'):
+            iposes, iterations = self.optimize_poses_batch(iposes, max_iterations, rngs[0])
+            seconds = [(time.time() - start_time) / len(seeds)] * len(seeds)
+        else:
+            iterations, seconds = [], []
+            for _iposes, rng in zip(iposes, rngs):
+                _, _iterations = self._optimize(_iposes, max_iterations, rng)
+                iterations += [_iterations]
+                seconds += [time.time() - start_time - sum(seconds)]
+        return [(_iposes, self._log_posterior(_iposes), _iterations, _seconds)
+                for _iposes, _iterations, _seconds in zip(iposes, iterations, seconds)]
+
+    def _initial_poses(self, i, rng, warm_start=False):
+        if i == 0 and warm_start:
+            # Poses of best_poses removed by eliminate_dead_ends start from
+            # the top remaining pose.
+            return np.argmax(self.pose_map == self.best_poses.reshape(-1, 1), axis=1)
+        if i == 0:
+            return np.zeros(len(self.ligands), dtype=int)
+        return rng.randint(self.max_poses, size=len(self.ligands))
+
+    def optimize_poses(self, poses, max_iterations, rng=np.random):
         """
         poses ({ligand_name: current pose number, })
         max_iterations (int)
+        rng (np.random.RandomState): Source of the order in which ligands are
+            updated.
+
+        Returns the optimized {ligand_name: pose number, }.
+        """
+        iposes, _ = self._optimize(self._iposes(poses), max_iterations, rng)
+        return dict(zip(self.ligands, iposes))
+
+    def _optimize(self, iposes, max_iterations, rng=np.random):
+        """
+        As optimize_poses, for iposes (np.array, # ligands), which is
+        updated in place.
+
+        Returns iposes and the number of iterations run.
+        """
+        if self.gc50 != float('inf'):
+            return self._optimize_poses_mp(iposes, max_iterations, rng)
+
+        # When gc50 is inf, all other ligands are assumed to be correctly
+        # posed, so the best pose for a ligand maximizes its single energy plus
+        # the mean pair energy to the current poses of the other ligands.
+        # field[i] holds the summed pair energies of each pose of ligand i to
+        # the current poses, and is updated in place when a pose changes.
+        field = self._local_field(iposes)
+        scale = 1 / max(len(self.ligands)-1, 1)
+        iterations = 0
+        for _ in range(max_iterations):
+            iterations += 1
+            update = False
+            for iquery in rng.permutation(len(self.ligands)):
+                best_pose = np.argmax(self.single[iquery] + scale*field[iquery])
+                if best_pose != iposes[iquery]:
+                    update = True
+                    field += self.pair.columns(iquery, best_pose)
+                    field -= self.pair.columns(iquery, iposes[iquery])
+                    iposes[iquery] = best_pose
+            if not update:
+                break
+        return iposes, iterations
+
+    def optimize_poses_batch(self, iposes, max_iterations, rng=np.random):
+        """
+        Coordinate ascent on the log posterior for several independent
+        restarts at once, as done by optimize_poses when gc50 is inf.
+
+        Each sweep updates every ligand in turn for all restarts that have
+        not yet converged, keeping a local field per restart as in
+        optimize_poses.
+
+        iposes (np.array, # restarts x # ligands): initial pose numbers,
+            updated in place.
+        max_iterations (int)
+        rng (np.random.RandomState): Source of the order in which ligands are
+            updated, shared by all restarts.
+
+        Returns iposes and the number of iterations run for each restart.
+        """
+        field = np.zeros((iposes.shape[0],) + self.single.shape)
+        for lig in range(len(self.ligands)):
+            field += self.pair.columns(lig, iposes[:, lig])
+        scale = 1 / max(len(self.ligands)-1, 1)
+        active = np.arange(iposes.shape[0])
+        iterations = np.zeros(iposes.shape[0], dtype=int)
+        for _ in range(max_iterations):
+            iterations[active] += 1
+            update = np.zeros(active.shape, dtype=bool)
+            for iquery in rng.permutation(len(self.ligands)):
+                best_pose = np.argmax(self.single[iquery] + scale*field[active, iquery],
+                                      axis=1)
+                changed = best_pose != iposes[active, iquery]
+                if not np.any(changed):
+                    continue
+                update |= changed
+                rows = active[changed]
+                field[rows] += (self.pair.columns(iquery, best_pose[changed])
+                                - self.pair.columns(iquery, iposes[rows, iquery]))
+                iposes[rows, iquery] = best_pose[changed]
+            active = active[update]
+            if not active.shape[0]:
+                break
+        return iposes, iterations
+
+    def max_product(self, max_iterations, rho=1.0, damping=0.5, tol=1e-4,
+                    chunk_size=256):
+        """
+        Approximately maximize the log posterior by max-product message
+        passing over the fully connected graph of ligands.
+
+        With rho < 1 this is tree-reweighted max-product, using the same edge
+        appearance probability rho for every ligand pair; 2 / # ligands is
+        the value for a uniform distribution over spanning trees. Messages
+        for all ligand pairs are updated in parallel, in chunks of
+        chunk_size pairs, and damped by damping.
+
+        Returns the poses maximizing each ligand's max-marginal and an upper
+        bound on the log posterior (see _star_bound) computed from the final
+        messages, so it is valid whether or not message passing converged.
+        """
+        n = len(self.ligands)
+        pairs = np.array(np.nonzero(np.triu(self.pair.index >= 0))).T
+        theta = np.where(self.pose_map >= 0, (n-1)*self.single, -np.inf)
+
+        # messages[i, j] is the message from ligand i to ligand j.
+        messages = np.zeros((n, n, self.max_poses))
+        update = np.zeros(messages.shape)
+        for _ in range(max_iterations):
+            belief = theta + rho*messages.sum(axis=0)
+            for start in range(0, len(pairs), chunk_size):
+                i, j = pairs[start:start+chunk_size].T
+                blocks = self.pair.blocks[self.pair.index[i, j]]
+                to_j = rho*(belief[i] - messages[j, i])
+                to_i = rho*(belief[j] - messages[i, j])
+                update[i, j] = (blocks + to_j[:, :, None]).max(axis=1)
+                update[j, i] = (blocks + to_i[:, None, :]).max(axis=2)
+            update /= rho
+            update -= update.max(axis=2, keepdims=True)
+
+            delta = np.abs(update - messages).max()
+            messages *= damping
+            messages += (1-damping)*update
+            if delta < tol:
+                break
+        else:
+            print('Max-product did not converge.')
+
+        belief = theta + rho*messages.sum(axis=0)
+        bound = self._star_bound(theta, rho*messages, pairs, chunk_size)
+        return belief.argmax(axis=1), bound
+
+    def _star_bound(self, theta, messages, pairs, chunk_size=256):
         """
+        Returns an upper bound on the log posterior given a reparametrization.
+
+        messages[i, j] is moved from the pair term for ligands i and j to the
+        single term for ligand j. The reparametrized problem is split evenly
+        over the # ligands stars (each ligand connected to all others), which
+        are spanning trees, so each can be maximized exactly. For the star
+        weights used by max_product with rho = 2 / # ligands, this is the
+        tree-reweighted bound.
+        """
+        n = len(self.ligands)
+        node = theta + messages.sum(axis=0)
+        node_max = node.max(axis=1)
+        star = node + (node_max.sum() - node_max).reshape(-1, 1)
+        for start in range(0, len(pairs), chunk_size):
+            i, j = pairs[start:start+chunk_size].T
+            edge = (n/2)*(self.pair.blocks[self.pair.index[i, j]]
+                          - messages[j, i][:, :, None]
+                          - messages[i, j][:, None, :])
+            np.add.at(star, i, (edge + node[j][:, None, :]).max(axis=2)
+                               - node_max[j].reshape(-1, 1))
+            np.add.at(star, j, (edge + node[i][:, :, None]).max(axis=1)
+                               - node_max[i].reshape(-1, 1))
+        return star.max(axis=1).sum() / n
+
+    def _local_field(self, iposes):
+        """
+        Returns the (# ligands x max_poses) summed pair energies of every pose
+        of each ligand to the poses iposes of all other ligands.
+        """
+        field = np.zeros(self.single.shape)
+        for lig, pose in enumerate(iposes):
+            field += self.pair.columns(lig, pose)
+        return field
+
+    def _optimize_poses_mp(self, iposes, max_iterations, rng=np.random):
+        # Successive calls to message_passing differ by one ligand's pose, so
+        # start each from the previous result. Reset for every restart so
+        # that restarts don't depend on each other.
+        self.q[:] = np.nan
+        iterations = 0
         for _ in range(max_iterations):
+            iterations += 1
             update = False
-            for query in np.random.permutation(list(poses.keys())):
-                iposes = self.poses_to_iposes(
-                        {lig: pose for lig, pose in poses.items() if lig != query})
-                iquery = self.ligands.index(query)
+            for iquery in rng.permutation(len(self.ligands)):
                 best_pose = self.best_pose(iposes, iquery)
-                if best_pose != poses[query]:
+                if best_pose != iposes[iquery]:
                     update = True
-                    poses[query] = best_pose
+                    iposes[iquery] = best_pose
             if not update:
                 break
-        return poses
+        return iposes, iterations
 
     def anneal_poses(self, poses, max_iterations):
         """
         poses ({ligand_name: current pose number, })
         max_iterations (int)
         """
+        iposes = self._iposes(poses)
         for T in np.logspace(2, -2, 11):
             print(T)
             for i in range(1000):
                 print(i, 'of', len(self.ligands)*self.max_poses)
-                for query in np.random.permutation(list(poses.keys())):
-                    iposes = self.poses_to_iposes(
-                            {lig: pose for lig, pose in poses.items() if lig != query})
-                    iquery = self.ligands.index(query)
+                for iquery in np.random.permutation(len(self.ligands)):
                     probs = self.get_probs(iposes, iquery)[:, 0]
                     probs = np.exp(np.log(probs)/T)
                     probs /= probs.sum()
-                    poses[query] = np.random.choice(range(len(probs)), p=probs)
-        return self.optimize_poses(poses, max_iterations)
+                    iposes[iquery] = np.random.choice(range(len(probs)), p=probs)
+        return self.optimize_poses(dict(zip(self.ligands, iposes)), max_iterations)
 
     def best_pose(self, iposes, iquery):
-        p = self.get_probs(iposes, iquery)
+        p = self.get_probs(iposes, iquery, warm_start=True)
         return np.argmax(p[:, 0])
 
-    def get_probs(self, iposes, iquery):
+    def get_probs(self, iposes, iquery, warm_start=False):
+        """
+        Returns the (max_poses x 2) probabilities that each pose of ligand
+        iquery is correct and incorrect, given the poses iposes (np.array,
+        # ligands) of all other ligands.
+        """
+        others = np.delete(np.arange(len(self.ligands)), iquery)
         if self.gc50 == float('inf'):
-            q = np.zeros((len(iposes), 2))
+            q = np.zeros((len(others), 2))
             q[:, 0] = 1.0
         else:
-            q = self.get_prob(iposes)
-
-        _corr = np.array([[self.corr[lig1, lig2] for lig2 in iposes] for lig1 in iposes])
-        C = self.correlations(_corr, q).reshape(-1, 1)
+            q = self.get_prob(iposes, others, warm_start)
 
-        _pair = np.array([self.pair[iquery, lig, :, pose] for lig, pose in iposes.items()])
+        C = self.correlations(self.corr[np.ix_(others, others)], q).reshape(-1, 1)
+        _pair = self.pair.to_poses(iquery, iposes)[others]
 
-        p = np.vstack([self.single[iquery, :], np.zeros(self.single[iquery, :].shape)]).T
-        p[:, 0] += np.sum(C*np.log(q[:, :1]*np.exp(_pair) + q[:, 1:]), axis=0)
-        p = np.exp(p)
-        p /= p.sum(axis=1, keepdims=True)
-        return p
+        with np.errstate(divide='ignore'):
+            log_q = np.log(q)
+        z = self.single[iquery] + np.sum(C*np.logaddexp(log_q[:, :1] + _pair,
+                                                        log_q[:, 1:]), axis=0)
+        return np.vstack([np.exp(-np.logaddexp(0, -z)),
+                          np.exp(-np.logaddexp(0, z))]).T
 
     def get_poses_prob(self, poses):
-        iposes = self.poses_to_iposes(poses)
-        probs = self.get_prob(iposes)[:, 0]
-
-        ligands = [(self.ligands.index(lig), lig) for lig in poses]
-        ligands = sorted(ligands)
-        ligands = [lig[1] for lig in ligands]
-        return {lig: prob for lig, prob in zip(ligands, probs)}
-
-    def get_prob(self, iposes):
-        single = np.array([self.single[l, p] for l, p in iposes.items()])
-        pair = np.array([[self.pair[l1, l2, p1, p2] for l2, p2 in iposes.items()]
-                          for l1, p1 in iposes.items()])
-        corr = np.array([[self.corr[l1, l2] for l2 in iposes] for l1 in iposes])
-        return self.message_passing(single, pair, corr)
-
-    def message_passing(self, single, pair, corr, max_iter=100, tol=0.0001):
-        q_old = np.vstack([single, np.zeros(single.shape)]).T
-        q_old = np.exp(q_old)
-        q_old /= q_old.sum(axis=1, keepdims=True)
+        ligands, iposes = self._considered_poses(poses)
+        probs = self.get_prob(iposes, ligands)[:, 0]
+        return {self.ligands[i]: prob for i, prob in zip(ligands, probs)}
+
+    def get_prob(self, iposes, ligands=None, warm_start=False):
+        """
+        iposes (np.array, # ligands): pose of each ligand.
+        ligands (np.array): Indices of the ligands to consider, all if None.
+        warm_start (bool): Start message passing from, and update, self.q.
+        """
+        if ligands is None:
+            ligands = np.arange(len(self.ligands))
+        single = self.single[ligands, iposes[ligands]]
+        pair = self.pair.pose_matrix(ligands, iposes[ligands]).astype(float)
+        corr = self.corr[np.ix_(ligands, ligands)]
+        if not warm_start:
+            return self.message_passing(single, pair, corr)
+
+        q = self.message_passing(single, pair, corr, q0=self.q[ligands])
+        self.q[ligands] = q[:, 0]
+        return q
+
+    def message_passing(self, single, pair, corr, max_iter=100, tol=0.0001,
+                        damping=0.0, q0=None):
+        """
+        Returns q (np.array, # ligands x 2), the probabilities that the
+        current pose of each ligand is correct and incorrect, by iterating
+
+            log(q[i, 0] / q[i, 1]) = single[i]
+                + sum_j C[j] log(q[j, 0] exp(pair[i, j]) + q[j, 1])
+
+        from q[i, 0] = q0[i] or, where q0 is None or nan,
+        q[i, 0] = 1 / (1 + exp(-single[i])).
+
+        The update is computed in the log domain, so large pair energies do
+        not overflow, using work buffers allocated once per call. damping is
+        the fraction of the previous q[:, 0] kept at each iteration.
+        """
+        n = single.shape[0]
+        work = np.empty((n, n))
+        C = np.empty(n)
+        z = single.astype(float)
+
+        if q0 is None:
+            log_q0, log_q1 = -np.logaddexp(0, -z), -np.logaddexp(0, z)
+            q0 = np.exp(log_q0)
+        else:
+            q0 = np.where(np.isnan(q0), np.exp(-np.logaddexp(0, -z)), q0)
+            with np.errstate(divide='ignore'):
+                log_q0, log_q1 = np.log(q0), np.log1p(-q0)
+
+        self.message_passing_calls += 1
         for _ in range(max_iter):
-            q = np.vstack([single, np.zeros(single.shape)]).T
-            C = self.correlations(corr, q_old)
-            q[:, 0] += np.sum(C*np.log(q_old[:, 0]*np.exp(pair) + q_old[:, 1]), axis=1)
-            q = np.exp(q)
-            q /= q.sum(axis=1, keepdims=True)
-            if np.max(np.abs(q - q_old)) < tol:
+            self.message_passing_iterations += 1
+            np.multiply(corr, q0, out=work)
+            np.fill_diagonal(work, 1)
+            np.reciprocal(work.sum(axis=1, out=C), out=C)
+
+            np.add(pair, log_q0, out=work)
+            np.logaddexp(work, log_q1, out=work)
+            work *= C
+            np.add(single, work.sum(axis=1, out=z), out=z)
+
+            q0_old = q0
+            if damping:
+                q0 = (1-damping)*np.exp(-np.logaddexp(0, -z)) + damping*q0_old
+                with np.errstate(divide='ignore'):
+                    log_q0, log_q1 = np.log(q0), np.log1p(-q0)
+            else:
+                log_q0, log_q1 = -np.logaddexp(0, -z), -np.logaddexp(0, z)
+                q0 = np.exp(log_q0)
+
+            if np.max(np.abs(q0 - q0_old)) < tol:
                 break
-            q_old = q
         else:
-            print('Message passing did not converge.') 
-        return q
+            print('Message passing did not converge.')
+        return np.vstack([q0, np.exp(log_q1)]).T
 
     def correlations(self, corr, q):
         C = corr*q[:, 0].reshape(1, -1)
@@ -225,16 +982,53 @@ class PosePrediction:
         This should only be used for debugging purposes, as when optimizing we
         only need to consider terms that involve the ligand being considered.
         """
-        iposes = list(self.poses_to_iposes(poses).items())
-
-        lr = 0
-        for lig, pose in iposes:
-            lr += (len(poses)-1)*self.single[lig, pose]
+        return self._log_posterior(self._iposes(poses))
 
-        for i, (lig1, pose1) in enumerate(iposes):
-            for lig2, pose2 in iposes[i+1:]:
-                lr += self.pair[lig1, lig2, pose1, pose2]
+    def _log_posterior(self, iposes):
+        """
+        As log_posterior, for iposes (np.array, # ligands).
+        """
+        ligands = np.arange(len(self.ligands))
+        lr = (len(ligands)-1)*self.single[ligands, iposes].sum()
+        lr += self.pair.pose_matrix(ligands, iposes).sum(dtype=float) / 2
         return lr
- 
-    def poses_to_iposes(self, poses):
-        return {self.ligands.index(lig): pose for lig, pose in poses.items()}
+
+SOLVERS = ['greedy', 'max-product', 'trws']
+
+###############################################################################
+# Worker processes for max_posterior. Each worker holds one PosePrediction,
+# with its pair energies memory mapped, set when the pool starts.
+
+_worker = None
+
+def _init_worker(ps):
+    global _worker
+    _worker = ps
+
+def _restarts(args):
+    return _worker._restarts(*args)
+
+###############################################################################
+# Output
+
+POSE_COLUMNS = ['ID', 'POSE', 'PROB', 'COMBIND_RMSD', 'GLIDE_RMSD', 'BEST_RMSD']
+
+def pose_rows(best_poses, probs, raw):
+    rows = []
+    for ligand in best_poses:
+        if 'rmsd' in raw and ligand in raw['rmsd']:
+            rmsds = raw['rmsd'][ligand]
+            grmsd = rmsds[0]
+            crmsd = rmsds[best_poses[ligand]]
+            brmsd = min(rmsds)
+        else:
+            grmsd, crmsd, brmsd = None, None, None
+        rows += [[ligand.replace('_pv', ''), best_poses[ligand], probs[ligand],
+                  crmsd, grmsd, brmsd]]
+    return rows
+
+def write_poses(out, best_poses, probs, raw):
+    with open(out, 'w') as fp:
+        fp.write(','.join(POSE_COLUMNS) + '\n')
+        for row in pose_rows(best_poses, probs, raw):
+            fp.write(','.join(map(str, row)) + '\n')
@@ -1,26 +1,33 @@
 import numpy as np
 import pandas as pd
-from utils import np_load
-from schrodinger.structure import StructureReader, StructureWriter
+import os
+from score.log_ratio import log_ratio
 
 def load_features_screen(features, gscore_fname, ifp_fname,
-                         mcss_fname=None, shape_fname=None):
-    single = np.load(gscore_fname)
+                         mcss_fname=None, shape_fname=None, mmap_mode='r'):
+    """
+    Load docking scores and (library poses x binders) pair features. By
+    default these are memory mapped, so that screen only reads them a chunk
+    of poses at a time.
+    """
+    from utils import np_load
+    single = np.load(gscore_fname, mmap_mode=mmap_mode)
 
     raw = {}
     for feature in features:
         if feature == 'mcss':
-            raw['mcss'] = np_load(mcss_fname)
+            raw['mcss'] = np_load(mcss_fname, mmap_mode=mmap_mode)
         elif feature == 'shape':
-            raw['shape'] = np_load(shape_fname)
+            raw['shape'] = np_load(shape_fname, mmap_mode=mmap_mode)
         else:
-            raw[feature] = np_load(ifp_fname.format(feature))
+            raw[feature] = np_load(ifp_fname.format(feature), mmap_mode=mmap_mode)
     return single, raw
 
 def scores_to_csv(pv, out):
     """
     Write docking and ComBind scores to text.
     """
+    from schrodinger.structure import StructureReader
     titles, glide, combind = [], [], []
     with StructureReader(pv) as reader:
         next(reader)
@@ -33,10 +40,63 @@ def scores_to_csv(pv, out):
                       columns = ['ID', 'GLIDE', 'COMBIND'])
     df.to_csv(out, index=False)
 
+def load_titles(pv, name_fname=None):
+    """
+    Returns the title of each pose in a poseviewer, read from name_fname,
+    as written by Features.compute_name, if it exists, else from pv.
+    """
+    if name_fname is not None and os.path.exists(name_fname):
+        return np.load(name_fname)
+
+    from schrodinger.structure import StructureReader
+
+    titles = []
+    with StructureReader(pv) as reader:
+        next(reader)
+        for st in reader:
+            titles += [st.title]
+    return np.array(titles)
+
+def best_poses(titles, scores, top_k=None, descending=False):
+    """
+    Returns the index of the best pose with each title, sorted best first,
+    as glide_sort -best_by_title. The best pose has the lowest score, as
+    for docking scores, or, if descending, the highest, as for ComBind
+    scores. If top_k, only the top_k best titles are kept.
+    """
+    assert len(titles) == len(scores), \
+        '{} titles for {} scores.'.format(len(titles), len(scores))
+    key = -np.asarray(scores) if descending else np.asarray(scores)
+    _, compound = np.unique(titles, return_inverse=True)
+    order = np.lexsort((key, compound))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = compound[order[1:]] != compound[order[:-1]]
+    best = order[first]
+
+    if top_k is not None and top_k < len(best):
+        best = best[np.argpartition(key[best], top_k)[:top_k]]
+    return best[np.argsort(key[best], kind='stable')]
+
+def write_best_poses(basename, titles, glide, combind, top_k=None):
+    """
+    Write the docking and ComBind scores of the best pose of each compound,
+    ranked by ComBind score, highest first, to {basename}_combind.csv and
+    by docking score, lowest first, to {basename}_glide.csv, as
+    scores_to_csv.
+    """
+    titles, glide, combind = np.asarray(titles), np.asarray(glide), np.asarray(combind)
+    for name, scores, descending in [('combind', combind, True),
+                                     ('glide', glide, False)]:
+        best = best_poses(titles, scores, top_k, descending)
+        df = pd.DataFrame({'ID': titles[best], 'GLIDE': glide[best],
+                           'COMBIND': combind[best]})
+        df.to_csv('{}_{}.csv'.format(basename, name), index=False)
+
 def apply_scores(pv, scores, out):
     """
     Add ComBind screening scores to a poseviewer.
     """
+    from schrodinger.structure import StructureReader, StructureWriter
 
     scores = np.load(scores)
 
@@ -48,25 +108,36 @@ def apply_scores(pv, scores, out):
             st.property['r_i_combind_score'] = score
             writer.append(st)
 
-def screen(single, raw, stats, alpha, weights=None):
-    energies = {}
-    for feature in raw:
-        _raw = raw[feature]
-        _stats = stats[feature]
-        energies[feature] = (  np.log(_stats['native'](_raw))
-                             - np.log(_stats['reference'](_raw)))
-
-    pair_energy = 0
-    for feature, energy in energies.items():
-        pair_energy += energy
+def screen(single, raw, stats, alpha, weights=None, chunk_size=10**4):
+    """
+    Returns the ComBind score of each library pose.
 
-    n = pair_energy.shape[1]
+    Library poses are scored chunk_size at a time, summing the log density
+    ratio of each feature into one (chunk_size x binders) array, so memory
+    use does not grow with the size of the library.
+    """
+    n = next(iter(raw.values())).shape[1]
 
     if weights is None:
         weights = np.ones(n)
 
     alpha /= 0.5 * n / (1 + (n-1)*0.5)
 
-    pair_energy = (pair_energy*weights.reshape(1, -1)).mean(axis=1)
-    combind_energy = pair_energy/alpha - single
+    # Mean over binders of the weighted pair energies.
+    weights = np.asarray(weights, dtype=float) / n
+
+    combind_energy = np.empty(len(single))
+    for start in range(0, len(single), chunk_size):
+        end = min(start + chunk_size, len(single))
+        pair_energy = None
+        for feature in raw:
+            energy = log_ratio(stats[feature], raw[feature][start:end])
+            if pair_energy is None:
+                pair_energy = energy
+            else:
+                pair_energy += energy
+        combind_energy[start:end] = pair_energy @ weights
+
+    combind_energy /= alpha
+    combind_energy -= single
     return combind_energy
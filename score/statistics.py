@@ -1,63 +1,184 @@
 import numpy as np
 from score.density_estimate import DensityEstimate
+from score.log_ratio import LogRatio
 from features.features import Features
+from utils import mkdir, mp
 from glob import glob
 import os
+import shutil
 import pandas as pd
 
-def read_stats(stats_root, features):
+def _compiled_is_current(stats_root, feature):
+    '''
+    Returns whether stats_root/{feature}.npz exists and is newer than the
+    text statistics it was compiled from, if they exist.
+    '''
+    fname = '{}/{}.npz'.format(stats_root, feature)
+    if not os.path.exists(fname):
+        return False
+    for dist in ['native', 'reference']:
+        text = '{}/{}_{}.txt'.format(stats_root, dist, feature)
+        if os.path.exists(text) and os.path.getmtime(text) > os.path.getmtime(fname):
+            print('{} is older than {}, ignoring it.'.format(fname, text))
+            return False
+    return True
+
+def read_stats(stats_root, features, compiled=True):
+    '''
+    Returns {feature: {'native': DensityEstimate, 'reference': DensityEstimate}},
+    or, if compiled and stats_root/{feature}.npz, as written by
+    compile_stats, exists and is newer than the text statistics,
+    {feature: LogRatio}.
+    '''
     stats = {}
+    for interaction in features:
+        fname = '{}/{}.npz'.format(stats_root, interaction)
+        if compiled and _compiled_is_current(stats_root, interaction):
+            stats[interaction] = LogRatio.read(fname)
+
     for dist in ['native', 'reference']:
         for interaction in features:
+            if isinstance(stats.get(interaction), LogRatio): continue
             fname = '{}/{}_{}.txt'.format(stats_root, dist, interaction)
             assert os.path.exists(fname), fname
             if interaction not in stats: stats[interaction] = {}
             stats[interaction][dist] = DensityEstimate.read(fname)
     return stats
 
-def pair_features(protein, data_root, pairs_root):
-    interactions = ['hbond',  'saltbridge', 'contact', 'shape', 'mcss']
-    features = Features(data_root + '/' + protein, max_poses=100)
-    features.load_features(interactions)
-    features = features.raw
+def compile_stats(stats_root, features, out_root=None):
+    '''
+    Write the log density ratio of the text statistics in stats_root for
+    each feature to out_root/{feature}.npz, which read_stats then uses.
+    '''
+    if out_root is None:
+        out_root = stats_root
+    stats = read_stats(stats_root, features, compiled=False)
+    for feature in features:
+        log_ratio = LogRatio.from_densities(stats[feature]['native'],
+                                            stats[feature]['reference'])
+        log_ratio.write('{}/{}.npz'.format(out_root, feature))
 
-    # get cross-docked ligands
-    ligands = []
-    for ligand in sorted(features['gscore'].keys()):
+def cross_docked(ligands):
+    '''
+    Returns the sorted ligands docked to a structure other than their own,
+    excluding native poses and CHEMBL ligands.
+    '''
+    _ligands = []
+    for ligand in sorted(ligands):
         if 'native' in ligand: continue
         lig, grid = ligand.split('-to-')
         if '_lig' in lig:
             lig = lig.replace('_lig', '')
         if lig != grid and 'CHEMBL' not in lig:
-            ligands += [ligand]
+            _ligands += [ligand]
+    return _ligands
+
+def pair_table(raw, ligands, interactions):
+    '''
+    Yields the columns of the pair table for each pair of ligands, i < j,
+    as {column: np.array}, with a row for every pair of their poses, in
+    order of rank1 then rank2. Ligands are given by their index in ligands.
 
-    df = []
+    raw (dict): pair features keyed by (ligand1, ligand2), as Features.raw.
+    '''
     for i, ligand1 in enumerate(ligands):
-        for ligand2 in ligands[i+1:]:
-            for r1 in range(len(features['gscore'][ligand1])):
-                for r2 in range(len(features['gscore'][ligand2])):
-                    feats = [features[interaction][(ligand1, ligand2)][r1, r2]
-                             for interaction in interactions]
-                    gscore1 = features['gscore'][ligand1][r1]
-                    gscore2 = features['gscore'][ligand2][r2]
-                    rmsd1 = features['rmsd'][ligand1][r1]
-                    rmsd2 = features['rmsd'][ligand2][r2]
-                    df += [[protein,
-                            ligand1, ligand2,
-                            r1, r2,
-                            gscore1, gscore2,
-                            rmsd1, rmsd2]
-                            + feats]
-    df =  pd.DataFrame(df, columns=['protein',
-                                    'ligand1', 'ligand2',
-                                    'rank1', 'rank2',
-                                    'gscore1', 'gscore2',
-                                    'rmsd1', 'rmsd2']
-                                     +interactions)
-    df.to_csv('{}/{}.csv'.format(pairs_root, protein), index=False)
-
-def compute_stats(protein, pairs_root, stats_root, features):
-    df = pd.read_csv('{}/{}.csv'.format(pairs_root, protein))
+        gscore1 = np.asarray(raw['gscore'][ligand1])
+        rmsd1 = np.asarray(raw['rmsd'][ligand1])
+        n1 = len(gscore1)
+        for j in range(i+1, len(ligands)):
+            ligand2 = ligands[j]
+            gscore2 = np.asarray(raw['gscore'][ligand2])
+            rmsd2 = np.asarray(raw['rmsd'][ligand2])
+            n2 = len(gscore2)
+
+            rank1, rank2 = np.meshgrid(np.arange(n1, dtype=np.int32),
+                                       np.arange(n2, dtype=np.int32),
+                                       indexing='ij')
+            columns = {'ligand1': np.full(n1*n2, i, dtype=np.int32),
+                       'ligand2': np.full(n1*n2, j, dtype=np.int32),
+                       'rank1': rank1.ravel(), 'rank2': rank2.ravel(),
+                       'gscore1': np.repeat(gscore1, n2),
+                       'gscore2': np.tile(gscore2, n1),
+                       'rmsd1': np.repeat(rmsd1, n2),
+                       'rmsd2': np.tile(rmsd2, n1)}
+            for interaction in interactions:
+                block = raw[interaction][(ligand1, ligand2)][:n1, :n2]
+                columns[interaction] = np.asarray(block, dtype=float).ravel()
+            yield columns
+
+def write_pair_table(root, ligands, tables, chunksize=10**6):
+    '''
+    Write tables, as yielded by pair_table, to root/ligands.npy and a
+    series of root/{chunk}.npz files each holding about chunksize rows,
+    so that at most one chunk is in memory at a time.
+
+    The table is written to root.tmp and then replaces any table already
+    at root, so chunks of an older table are never read with it.
+    '''
+    tmp = root + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    mkdir(tmp)
+    np.save('{}/ligands.npy'.format(tmp), np.array(ligands, dtype=str))
+
+    def write(chunk, k):
+        columns = {column: np.concatenate([table[column] for table in chunk])
+                   for column in chunk[0]}
+        np.savez('{}/{}.npz'.format(tmp, k), **columns)
+
+    chunk, rows, k = [], 0, 0
+    for table in tables:
+        chunk += [table]
+        rows += len(table['rank1'])
+        if rows >= chunksize:
+            write(chunk, k)
+            chunk, rows, k = [], 0, k+1
+    if chunk:
+        write(chunk, k)
+
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.rename(tmp, root)
+
+def read_pair_table(root, protein=None, columns=None):
+    '''
+    Yields each chunk of the pair table written by write_pair_table as a
+    DataFrame, with ligand1 and ligand2 as categoricals sharing the
+    categories in root/ligands.npy. If columns is given, only those
+    columns are read.
+    '''
+    ligands = np.load('{}/ligands.npy'.format(root))
+    chunks = sorted(glob('{}/*.npz'.format(root)),
+                    key=lambda fname: int(os.path.basename(fname)[:-4]))
+    for fname in chunks:
+        with np.load(fname) as data:
+            df = pd.DataFrame({column: data[column] for column in data.files
+                               if columns is None or column in columns})
+        for column in ['ligand1', 'ligand2']:
+            if column in df:
+                df[column] = pd.Categorical.from_codes(df[column], ligands)
+        if protein is not None:
+            df.insert(0, 'protein', protein)
+        yield df
+
+def pair_features(protein, data_root, pairs_root, chunksize=10**6,
+                  interactions=['hbond',  'saltbridge', 'contact', 'shape', 'mcss']):
+    '''
+    Write the pair table for the cross-docked ligands of protein to
+    pairs_root/protein, as read by read_pair_table.
+    '''
+    features = Features(data_root + '/' + protein, max_poses=100)
+    features.load_features(sorted(features.get_poseviewers()),
+                           features=interactions, lazy=True)
+    features = features.raw
+
+    ligands = cross_docked(features['gscore'].keys())
+    tables = pair_table(features, ligands, interactions)
+    write_pair_table('{}/{}'.format(pairs_root, protein), ligands, tables,
+                     chunksize)
+
+def compute_stats(protein, pairs_root, stats_root, features, chunksize=10**6):
+    nat, ref = {}, {}
     for feature in features:
         if feature == 'mcss':
             sd = 0.03*6
@@ -65,13 +186,24 @@ def compute_stats(protein, pairs_root, stats_root, features):
         else:
             sd = 0.03
             domain = (0, 1)
-        
-        nat_vals = df.loc[(df.rmsd1 <= 2.0)&(df.rmsd2 <= 2.0), feature]
-        ref_vals = df.loc[:, feature]
-        nat = DensityEstimate(domain=domain, sd=sd).fit(nat_vals)
-        ref = DensityEstimate(domain=domain, sd=sd).fit(ref_vals)
-        nat.write('{}/{}/native_{}.de'.format(stats_root, protein, feature))
-        ref.write('{}/{}/reference_{}.de'.format(stats_root, protein, feature))
+        nat[feature] = DensityEstimate(domain=domain, sd=sd)
+        ref[feature] = DensityEstimate(domain=domain, sd=sd)
+
+    # Stream the pairs so that they never all need to be in memory.
+    root = '{}/{}'.format(pairs_root, protein)
+    if os.path.isdir(root):
+        chunks = read_pair_table(root, columns=['rmsd1', 'rmsd2'] + features)
+    else:
+        chunks = pd.read_csv(root + '.csv', chunksize=chunksize)
+    for df in chunks:
+        native = (df.rmsd1 <= 2.0)&(df.rmsd2 <= 2.0)
+        for feature in features:
+            nat[feature].partial_fit(df.loc[native, feature])
+            ref[feature].partial_fit(df.loc[:, feature])
+
+    for feature in features:
+        nat[feature].finalize().write('{}/{}/native_{}.de'.format(stats_root, protein, feature))
+        ref[feature].finalize().write('{}/{}/reference_{}.de'.format(stats_root, protein, feature))
 
 def merge_stats(proteins, stats_root, merged_stats_fname, features):
     for feature in features:
@@ -86,3 +218,111 @@ def merge_stats(proteins, stats_root, merged_stats_fname, features):
         ref_fname = merged_stats_fname.format('reference', feature)
         DensityEstimate.merge(nat_des).write(nat_fname)
         DensityEstimate.merge(ref_des).write(ref_fname)
+
+def merge_stats_subsets(proteins, stats_root, subsets, features):
+    '''
+    Merge the statistics of proteins, as written by compute_stats, for each
+    of several subsets of them, with one matrix product per feature.
+
+    subsets ({out_root: [protein, ]}): proteins to merge into each out_root,
+        written as read by read_stats, including the compiled tables.
+    '''
+    weights = np.array([[protein in subset for protein in proteins]
+                        for subset in subsets.values()], dtype=float)
+    for out_root in subsets:
+        mkdir(out_root)
+
+    for feature in features:
+        merged = {}
+        for dist in ['native', 'reference']:
+            des = [DensityEstimate.read('{}/{}/{}_{}.de'.format(stats_root, protein,
+                                                                 dist, feature))
+                   for protein in proteins]
+            x, fx, n_samples = DensityEstimate.stack(des)
+            merged[dist] = DensityEstimate.merge_stacked(x, fx, n_samples, weights,
+                                                         des[0].reflect)
+
+        for k, out_root in enumerate(subsets):
+            native, reference = merged['native'][k], merged['reference'][k]
+            native.write('{}/native_{}.txt'.format(out_root, feature))
+            reference.write('{}/reference_{}.txt'.format(out_root, feature))
+            log_ratio = LogRatio.from_densities(native, reference)
+            log_ratio.write('{}/{}.npz'.format(out_root, feature))
+
+###############################################################################
+# Training statistics from scratch for many proteins.
+
+def _inputs(root, features):
+    '''
+    Returns a description of the files in root that the statistics for
+    features are computed from, their size and modification time, which
+    changes if any of them do.
+    '''
+    protein = Features(root)
+    pvs = sorted(protein.get_poseviewers())
+    fnames = []
+    for i, pv1 in enumerate(pvs):
+        fnames += [protein.path('gscore', pv=pv1), protein.path('rmsd', pv=pv1)]
+        for pv2 in pvs[i+1:]:
+            fnames += [protein.path(feature, pv=pv1, pv2=pv2) for feature in features]
+
+    lines = [','.join(features)]
+    for fname in fnames:
+        if os.path.exists(fname):
+            stat = os.stat(fname)
+            lines += ['{},{},{}'.format(fname, stat.st_size, stat.st_mtime_ns)]
+    return '\n'.join(lines) + '\n'
+
+def train_protein(root, pairs_root, stats_root, features, chunksize=10**6):
+    '''
+    Compute the pair table and statistics of the protein at root, unless
+    they were already computed from the same inputs.
+
+    Returns True if the statistics were computed.
+    '''
+    protein = os.path.basename(os.path.abspath(root))
+    inputs = _inputs(root, features)
+    inputs_fname = '{}/{}/inputs.txt'.format(stats_root, protein)
+    if os.path.exists(inputs_fname):
+        with open(inputs_fname) as fp:
+            if fp.read() == inputs:
+                return False
+
+    pair_features(protein, os.path.dirname(os.path.abspath(root)), pairs_root,
+                  chunksize, features)
+    mkdir('{}/{}'.format(stats_root, protein))
+    compute_stats(protein, pairs_root, stats_root, features, chunksize)
+
+    # Written last, so that an interrupted run is repeated.
+    with open(inputs_fname, 'w') as fp:
+        fp.write(inputs)
+    return True
+
+def train_stats(roots, pairs_root, stats_root, out_root, features,
+                leave_one_out=False, processes=1, chunksize=10**6):
+    '''
+    Train statistics on the proteins at roots and merge them into out_root.
+
+    Each protein is handled by train_protein on a pool of processes. If
+    leave_one_out, statistics excluding each protein are also written to
+    out_root/without-{protein}.
+    '''
+    assert roots, 'No proteins to train statistics on.'
+    proteins = [os.path.basename(os.path.abspath(root)) for root in roots]
+    mkdir(pairs_root)
+    mkdir(stats_root)
+
+    args = [(root, pairs_root, stats_root, features, chunksize) for root in roots]
+    if processes == 1:
+        trained = [train_protein(*arg) for arg in args]
+    else:
+        trained = mp(train_protein, args, processes)
+    for protein, _trained in zip(proteins, trained):
+        print(protein, 'trained' if _trained else 'unchanged')
+
+    subsets = {out_root: proteins}
+    if leave_one_out:
+        for protein in proteins:
+            subsets['{}/without-{}'.format(out_root, protein)] = [
+                _protein for _protein in proteins if _protein != protein]
+    merge_stats_subsets(proteins, stats_root, subsets, features)
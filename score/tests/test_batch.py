@@ -0,0 +1,102 @@
+"""
+Tests for batch pose prediction.
+"""
+
+import pytest
+import os
+import numpy as np
+import pandas as pd
+
+from score.batch import read_manifest, estimate_memory, schedule, run_batch
+from score.density_estimate import DensityEstimate
+from features.features import Features
+
+@pytest.fixture(autouse=True)
+def combindhome(tmp_path, monkeypatch):
+	monkeypatch.setenv('COMBINDHOME', str(tmp_path))
+
+def make_system(root, n_poses, pair_features=True, seed=0):
+	rng = np.random.RandomState(seed)
+	features = Features(root)
+	pvs = []
+	for i, n in enumerate(n_poses):
+		pv = '{}/docking/lig{}/lig{}_pv.maegz'.format(root, i, i)
+		os.makedirs(os.path.dirname(pv))
+		open(pv, 'w').close()
+		np.save(features.path('gscore', pv=pv), -10*rng.rand(n))
+		np.save(features.path('rmsd', pv=pv), 3*rng.rand(n))
+		pvs += [pv]
+
+	if pair_features:
+		os.makedirs(root + '/shape')
+		for i, pv1 in enumerate(pvs):
+			for pv2 in pvs[i+1:]:
+				np.save(features.path('shape', pv=pv1, pv2=pv2),
+				        rng.rand(n_poses[i], n_poses[pvs.index(pv2)]))
+	return pvs
+
+def stats():
+	de = DensityEstimate(points = 2, domain = (0, 1))
+	de.x = np.array([0.0, 1.0])
+	de.fx = np.array([0.5, 1.5])
+	de.n_samples = 1
+	ref = DensityEstimate(points = 2, domain = (0, 1))
+	ref.x = np.array([0.0, 1.0])
+	ref.fx = np.array([1.0, 1.0])
+	ref.n_samples = 1
+	return {'shape': {'native': de, 'reference': ref}}
+
+PARAMS = {'features': ['shape'], 'alpha': 1.0, 'gc50': float('inf'),
+          'max_poses': 100, 'ifp_version': 'rd1', 'mcss_version': 'mcss16',
+          'shape_version': 'pharm_max', 'restart': 5, 'max_iterations': 100,
+          'seed': 0, 'batch_size': 1, 'eliminate_dead_ends': False,
+          'solver': 'greedy'}
+
+def test_read_manifest(tmp_path):
+	root = str(tmp_path / 'a')
+	pvs = make_system(root, [3, 4])
+	os.makedirs(root + '/docking/lig0_native')
+	open(root + '/docking/lig0_native/lig0_native_pv.maegz', 'w').close()
+	fname = str(tmp_path / 'manifest.csv')
+	pd.DataFrame({'ROOT': [root, root], 'OUT': [None, 'out.csv'],
+	              'LIGANDS': [None, 'x_pv.maegz y_pv.maegz'],
+	              'XTAL': [None, 'x_pv']}).to_csv(fname, index=False)
+
+	systems = read_manifest(fname)
+	assert systems[0] == {'root': root, 'out': root + '/poses.csv',
+	                      'pvs': pvs, 'xtal': []}
+	assert systems[1] == {'root': root, 'out': 'out.csv',
+	                      'pvs': ['x_pv.maegz', 'y_pv.maegz'], 'xtal': ['x_pv']}
+
+def test_estimate_memory(tmp_path):
+	pvs = make_system(str(tmp_path / 'a'), [3, 4, 5], pair_features=False)
+	features = Features('.')
+	raw = 8 * 2 * (12**2 - (9 + 16 + 25)) // 2
+	assert estimate_memory(features, pvs, 2, 100) == raw + 4 * 3 * 5**2
+	assert estimate_memory(features, pvs, 2, 4) == raw + 4 * 3 * 4**2
+
+def test_schedule():
+	order, processes = schedule([3, 10, 1, 5], processes=4)
+	assert list(order) == [1, 3, 0, 2]
+	assert processes == 4
+
+	assert schedule([3, 10, 1, 5], 4, memory=15)[1] == 2
+	assert schedule([3, 10, 1, 5], 4, memory=5)[1] == 1
+	assert schedule([3, 10, 1, 5], 2, memory=100)[1] == 2
+
+def test_run_batch_errors(tmp_path):
+	systems = []
+	for name, pair_features in [('good', True), ('bad', False)]:
+		root = str(tmp_path / name)
+		pvs = make_system(root, [3, 4], pair_features)
+		systems += [{'root': root, 'out': root + '/poses.csv', 'pvs': pvs,
+		             'xtal': []}]
+
+	table = run_batch(systems, stats(), PARAMS).set_index('ROOT')
+	good, bad = systems[0]['root'], systems[1]['root']
+	assert table.loc[good, 'ERROR'] == ''
+	assert table.loc[good, 'TOTAL'] >= 0
+	assert len(pd.read_csv(systems[0]['out'])) == 2
+	assert 'FileNotFoundError' in table.loc[bad, 'ERROR']
+	assert np.isnan(table.loc[bad, 'TOTAL'])
+	assert not os.path.exists(systems[1]['out'])
@@ -53,3 +53,86 @@ def test_merge():
 	merged = DensityEstimate.merge([de1, de2, de3])
 
 	assert np.all(merged.fx == [0.75, 0.75, 0.75])
+
+@pytest.mark.parametrize('reflect', [True, False])
+def test_binned_fit(reflect):
+	rng = np.random.RandomState(0)
+	X = rng.beta(2, 5, size=5000)
+	weights = rng.rand(5000)
+
+	exact = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	exact.fit(X.copy(), weights, exact=True)
+	binned = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	binned.fit(X.copy(), weights)
+
+	assert np.all(binned.x == exact.x)
+	assert binned.n_samples == exact.n_samples
+	assert binned.fx == pytest.approx(exact.fx, rel=1e-3, abs=1e-3)
+
+@pytest.mark.parametrize('reflect', [True, False])
+def test_partial_fit(reflect):
+	rng = np.random.RandomState(0)
+	X = rng.beta(2, 5, size=5000)
+	weights = rng.rand(5000)
+
+	expected = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	expected.fit(X.copy(), weights)
+
+	de = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	for i in range(0, 5000, 1200):
+		de.partial_fit(X[i:i+1200], weights[i:i+1200])
+	de.finalize()
+	assert np.all(de.x == expected.x)
+	assert de.n_samples == pytest.approx(expected.n_samples)
+	assert de.fx == pytest.approx(expected.fx)
+
+	# Values out of the domain, including inf, are squished onto it, as in fit.
+	X = rng.uniform(-0.2, 1.2, size=5000)
+	X[::10] = np.inf
+	expected = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	expected.fit(X.copy(), weights)
+	de = DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	de.partial_fit(X[:0])
+	for i in range(0, 5000, 1200):
+		de.partial_fit(X[i:i+1200], weights[i:i+1200])
+	de.finalize()
+	assert de.fx == pytest.approx(expected.fx)
+
+	des = [DensityEstimate(domain = (0, 1), sd = 0.03, reflect = reflect)
+	       for _ in range(3)]
+	des[0].partial_fit(X[:1000], weights[:1000])
+	des[2].partial_fit(X[1000:], weights[1000:])
+	merged = DensityEstimate.merge_partial(des).finalize()
+	assert merged.fx == pytest.approx(expected.fx)
+	assert merged.n_samples == pytest.approx(expected.n_samples)
+
+def test_partial_fit_empty():
+	de = DensityEstimate(points = 3, domain = (0, 2)).finalize()
+	assert np.all(de.fx == 0.5)
+	assert de.n_samples == 0
+
+def test_merge_stacked():
+	rng = np.random.RandomState(0)
+	des = []
+	for lo, hi, n in [(0, 1, 100), (0.5, 2, 300), (-1, 1, 0), (0, 2, 50)]:
+		de = DensityEstimate(points = 5, domain = (lo, hi))
+		de.x = np.linspace(lo, hi, 5)
+		de.fx = rng.rand(5)
+		de.n_samples = n
+		des += [de]
+
+	merged = DensityEstimate.merge(des)
+	x = np.linspace(0, 2, 5)
+	assert np.all(merged.x == x)
+	assert merged.n_samples == 450
+	assert merged.fx == pytest.approx((100*des[0](x) + 300*des[1](x)
+	                                   + 50*des[3](x)) / 450)
+
+	x, fx, n_samples = DensityEstimate.stack(des)
+	subsets = np.array([[1, 1, 1, 1], [0, 1, 0, 0], [0, 0, 1, 0]])
+	merged = DensityEstimate.merge_stacked(x, fx, n_samples, subsets)
+	assert len(merged) == 3
+	assert merged[1].fx == pytest.approx(des[1](x))
+	assert merged[1].n_samples == 300
+	assert merged[2].n_samples == 0
+	assert merged[2].fx == pytest.approx(np.ones(5) / 3)
@@ -0,0 +1,140 @@
+"""
+Tests for the pair table stages used to train statistics.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from score.statistics import pair_table, write_pair_table, read_pair_table
+from score.features_to_df import (transform_pairs, first_correct_pairs,
+                                  weight_pairs, _run)
+
+FEATURES = ['hbond', 'saltbridge', 'contact', 'shape', 'mcss']
+KEYS = ['protein', 'ligand1', 'ligand2', 'rank1', 'rank2']
+
+def make_raw(seed):
+	rng = np.random.RandomState(seed)
+	ligands = ['a-to-x', 'b-to-x', 'c-to-y']
+	raw = {'gscore': {ligand: -10*rng.rand(n) for ligand, n in zip(ligands, [3, 4, 2])}}
+	raw['rmsd'] = {ligand: 4*rng.rand(len(raw['gscore'][ligand])) for ligand in ligands}
+	for feature in FEATURES:
+		raw[feature] = {(ligand1, ligand2): 8*rng.rand(5, 5)
+		                for i, ligand1 in enumerate(ligands)
+		                for ligand2 in ligands[i+1:]}
+	for pair in raw['saltbridge']:
+		raw['saltbridge'][pair] = rng.choice([0.2, 0.5, 0.9], (5, 5))
+	raw['saltbridge'][('a-to-x', 'c-to-y')] = rng.choice([0.2, 0.5], (5, 5))
+	raw['mcss'][('a-to-x', 'b-to-x')][0, 0] = np.inf
+	return ligands, raw
+
+def write_pairs(root):
+	os.makedirs(root)
+	for seed, protein in enumerate(['p', 'q']):
+		ligands, raw = make_raw(seed)
+		write_pair_table('{}/{}'.format(root, protein), ligands,
+		                 pair_table(raw, ligands, FEATURES), chunksize=10)
+
+def read_pairs(root):
+	return pd.concat([df for protein in ['p', 'q']
+	                  for df in read_pair_table('{}/{}'.format(root, protein), protein)],
+	                 ignore_index=True)
+
+# The stages as they were written for csv files.
+def baseline_transform(data):
+	data = data.set_index(['protein', 'ligand1', 'ligand2'])
+	data['gscore1'] = -data['gscore1']
+	data['gscore2'] = -data['gscore2']
+	data['mcss']    = -data['mcss']
+	for col in data.columns:
+		data[col] = pd.to_numeric(data[col], errors='coerce')
+
+	data['no_mcss'] = data.mcss == -float('inf')
+	data.loc[data.no_mcss, 'mcss'] = 0.0
+	data.loc[(data['mcss'] < -6).to_numpy(), 'mcss'] = -6
+
+	data['no_saltbridge'] = 0
+	data.loc[data.groupby(level=[0, 1, 2]).max()['saltbridge'] == 0.5, 'no_saltbridge'] = 1
+
+	data_rev = data.reset_index().rename(columns={'gscore1': 'gscore2', 'gscore2': 'gscore1',
+	                                  'rank1': 'rank2', 'rank2': 'rank1',
+	                                  'rmsd1': 'rmsd2', 'rmsd2': 'rmsd1',
+	                                  'ligand1': 'ligand2', 'ligand2': 'ligand1'})
+	data_rev = data_rev.set_index(['protein', 'ligand1', 'ligand2']).sort_index()
+	data_rev = data_rev[list(data.columns)]
+	return pd.concat([data, data_rev]).sort_index().reset_index()
+
+def baseline_first_correct(data):
+	data = data.loc[data['rmsd1'] <= 2.05].copy()
+	data['native'] = data['rmsd2'] <= 2.05
+	data['gscore'] = data['gscore2']
+	return data.reset_index(drop=True)
+
+def baseline_weight(data):
+	data = data.set_index(['protein', 'ligand1', 'ligand2'])
+
+	w = data.loc[data['native'] == 1, 'contact'].groupby(level=[0, 1, 2]).count()
+	data.loc[data['native'] == 1, 'W_lig_pair'] = 1/w
+
+	w = data.loc[data['native'] != 1, 'contact'].groupby(level=[0, 1, 2]).count()
+	data.loc[data['native'] != 1, 'W_lig_pair'] = 1/w
+
+	w = data.reset_index().groupby(['protein', 'ligand2']).nunique()[['ligand1']]
+	w = 1/w.rename(columns={'ligand1': 'W_ligand1'})
+	data = data.join(w)
+
+	w = data.reset_index().groupby(['protein', 'ligand1']).nunique()[['ligand2']]
+	w = 1/w.rename(columns={'ligand2': 'W_ligand2'})
+	data = data.join(w)
+	return data.reset_index()
+
+def assert_same(data, expected):
+	assert sorted(data.columns) == sorted(expected.columns)
+	data = data.sort_values(KEYS, ignore_index=True)
+	expected = expected.sort_values(KEYS, ignore_index=True)
+	for col in expected.columns:
+		if col in ['protein', 'ligand1', 'ligand2']:
+			assert list(data[col].astype(str)) == list(expected[col].astype(str)), col
+		else:
+			assert np.allclose(data[col].astype(float), expected[col].astype(float)), col
+
+def test_stages(tmp_path):
+	write_pairs(str(tmp_path / 'pairs'))
+	data = read_pairs(str(tmp_path / 'pairs'))
+	for col in ['ligand1', 'ligand2']:
+		data[col] = data[col].astype(str)
+
+	transformed = transform_pairs(data)
+	expected = baseline_transform(data)
+	assert_same(transformed, expected)
+	assert transformed['no_saltbridge'].any()
+	assert not transformed['no_saltbridge'].all()
+	assert transformed['no_mcss'].any()
+	assert transformed['mcss'].min() == -6
+
+	first_correct = first_correct_pairs(transformed)
+	expected = baseline_first_correct(expected)
+	assert_same(first_correct, expected)
+
+	weighted = weight_pairs(first_correct)
+	expected = baseline_weight(expected)
+	assert_same(weighted, expected)
+	assert weighted['native'].any()
+	assert not weighted['native'].all()
+
+def test_run(tmp_path):
+	write_pairs(str(tmp_path / 'pairs'))
+	data = read_pairs(str(tmp_path / 'pairs'))
+	data.to_csv(str(tmp_path / 'pairs.csv'), index=False)
+
+	stages = [('transform', transform_pairs), ('first_correct', first_correct_pairs),
+	          ('weight', weight_pairs)]
+	input = 'pairs'
+	for output, function in stages:
+		_run(function, str(tmp_path / input), str(tmp_path / output), chunksize=10)
+		_run(function, str(tmp_path / (input + '.csv')), str(tmp_path / (output + '.csv')))
+		input = output
+
+	weighted = read_pairs(str(tmp_path / 'weight'))
+	assert isinstance(weighted['ligand1'].dtype, pd.CategoricalDtype)
+	assert_same(weighted, pd.read_csv(str(tmp_path / 'weight.csv')))
@@ -0,0 +1,31 @@
+import pytest
+import numpy as np
+
+from score.density_estimate import DensityEstimate
+from score.log_ratio import LogRatio, log_ratio
+
+def density(x, fx):
+	de = DensityEstimate(points = len(x))
+	de.x = np.array(x, dtype=float)
+	de.fx = np.array(fx, dtype=float)
+	de.n_samples = 1
+	return de
+
+def test_log_ratio():
+	x = np.linspace(0, 1, 50)
+	stats = {'native': density(x, 1 + np.sin(3*x)**2),
+	         'reference': density(x, 2 - x)}
+	table = LogRatio.from_densities(stats['native'], stats['reference'])
+
+	X = np.random.RandomState(0).uniform(-0.5, 1.5, size=(100, 7))
+	X[0, :4] = [0, 1, np.inf, np.nan]
+	expected = log_ratio(stats, X)
+	assert table(X).shape == X.shape
+	assert table(X) == pytest.approx(expected, abs=1e-4, nan_ok=True)
+	assert np.isnan(table(X)[0, 3])
+
+def test_log_ratio_io(tmp_path):
+	table = LogRatio(0.5, 0.25, [0.0, 1.0, 3.0])
+	table.write(str(tmp_path / 'contact.npz'))
+	table = LogRatio.read(str(tmp_path / 'contact.npz'))
+	assert table(np.array([0.0, 0.625, 0.875, 2.0])) == pytest.approx([0, 0.5, 2, 3])
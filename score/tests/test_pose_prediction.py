@@ -0,0 +1,398 @@
+"""
+Tests for PosePrediction.
+"""
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from score.pose_prediction import PosePrediction
+from score.pair_energy import PairEnergy
+from score.density_estimate import DensityEstimate
+
+###############################################################################
+# Create PosePrediction objects
+
+def density(fx):
+	de = DensityEstimate(points = len(fx), domain = (0, 1))
+	de.x = np.linspace(0, 1, len(fx))
+	de.fx = np.array(fx, dtype=float)
+	de.n_samples = 1
+	return de
+
+def random_problem(n_ligands=4, n_poses=5, seed=0, missing=()):
+	rng = np.random.RandomState(seed)
+	ligands = ['lig{}'.format(i) for i in range(n_ligands)]
+	features = ['hbond', 'contact']
+	raw = {'gscore': {lig: -10*rng.rand(n_poses-i%2) for i, lig in enumerate(ligands)}}
+	for feature in features:
+		raw[feature] = {}
+		for i, lig1 in enumerate(ligands):
+			for lig2 in ligands[i+1:]:
+				shape = (len(raw['gscore'][lig1]), len(raw['gscore'][lig2]))
+				if (lig1, lig2) in missing:
+					raw[feature][(lig1, lig2)] = np.full(shape, float('inf'))
+				else:
+					raw[feature][(lig1, lig2)] = rng.rand(*shape)
+	stats = {feature: {'native': density(np.linspace(0.2, 2, 100)),
+	                   'reference': density(np.linspace(2, 0.2, 100))}
+	         for feature in features}
+	return ligands, raw, stats, features
+
+def dense_pair(ligands, raw, stats, features, max_poses):
+	pair = np.zeros((len(ligands), len(ligands), max_poses, max_poses))
+	for i, lig1 in enumerate(ligands):
+		for j in range(i+1, len(ligands)):
+			lig2 = ligands[j]
+			for feature in features:
+				_raw = raw[feature][(lig1, lig2)]
+				if _raw[0, 0] == float('inf'):
+					continue
+				energy = (np.log(stats[feature]['native'](_raw))
+				          - np.log(stats[feature]['reference'](_raw)))
+				pair[i, j, :energy.shape[0], :energy.shape[1]] += energy
+				pair[j, i, :energy.shape[1], :energy.shape[0]] += energy.T
+	return pair
+
+def pose_prediction(gc50=float('inf'), **kwargs):
+	ligands, raw, stats, features = random_problem(**kwargs)
+	return PosePrediction(ligands, raw, stats, [], features, 100, 1.0, gc50)
+
+###############################################################################
+
+def test_pair_energy_transpose():
+	pair = PairEnergy(3, 2, [(0, 2)])
+	pair.add(2, 0, np.array([[1.0, 2.0], [3.0, 4.0]]))
+
+	assert np.all(pair.block(2, 0) == [[1, 2], [3, 4]])
+	assert np.all(pair.block(0, 2) == [[1, 3], [2, 4]])
+	assert np.all(pair[0, 2, :, 1] == [3, 4])
+	assert pair[2, 0, 1, 0] == 3
+	assert (0, 1) not in pair
+	assert np.all(pair.block(0, 1) == 0)
+	assert np.all(pair.block(1, 1) == 0)
+	assert pair.blocks.dtype == np.float32
+
+def test_pair_energy_compact():
+	pair = PairEnergy(4, 2, [(0, 1), (0, 2), (1, 3), (2, 3)])
+	for k, (i, j) in enumerate([(0, 1), (0, 2), (1, 3), (2, 3)]):
+		pair.add(i, j, np.full((2, 2), k + 1.0))
+	pair.compact([(0, 2), (2, 3)])
+
+	assert pair.blocks.shape == (2, 2, 2)
+	assert (0, 1) not in pair and (1, 3) not in pair
+	assert np.all(pair.block(2, 0) == 2)
+	assert np.all(pair.block(3, 2) == 4)
+
+def test_pair_matches_dense():
+	ligands, raw, stats, features = random_problem(missing=[('lig0', 'lig2')])
+	ps = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'))
+	dense = dense_pair(ligands, raw, stats, features, ps.max_poses)
+
+	assert ps.pair.blocks.shape[0] == 5
+	assert (0, 2) not in ps.pair
+	for i in range(len(ligands)):
+		for j in range(len(ligands)):
+			assert ps.pair.block(i, j) == pytest.approx(dense[i, j], abs=1e-5)
+
+def test_log_posterior():
+	ps = pose_prediction()
+	ligands, raw, stats, features = random_problem()
+	dense = dense_pair(ligands, raw, stats, features, ps.max_poses)
+	poses = {'lig0': 1, 'lig1': 0, 'lig2': 3, 'lig3': 2}
+
+	expected = 3*sum(ps.single[i, poses[lig]] for i, lig in enumerate(ligands))
+	for i, lig1 in enumerate(ligands):
+		for j, lig2 in enumerate(ligands[i+1:], i+1):
+			expected += dense[i, j, poses[lig1], poses[lig2]]
+	assert ps.log_posterior(poses) == pytest.approx(expected, abs=1e-4)
+
+def test_pair_single_pass():
+	class Counter(dict):
+		reads = 0
+		def __getitem__(self, key):
+			Counter.reads += 1
+			return dict.__getitem__(self, key)
+
+	ligands, raw, stats, features = random_problem(n_ligands=5, missing=[('lig1', 'lig3')])
+	for feature in features:
+		raw[feature] = Counter(raw[feature])
+	ps = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'))
+	assert Counter.reads == len(features) * 5*4//2
+	assert (1, 3) not in ps.pair
+
+	Counter.reads = 0
+	ps = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'),
+	                    keep_feature_blocks=True)
+	expected = pose_prediction(n_ligands=5, missing=[('lig1', 'lig3')])
+	assert ps.pair.blocks == pytest.approx(expected.pair.blocks, abs=1e-5)
+	_ps = ps.configure(['hbond'])
+	assert Counter.reads == len(features) * 5*4//2
+	assert _ps.pair.blocks == pytest.approx(ps.feature_blocks['hbond'])
+
+def test_columns():
+	ps = pose_prediction(n_ligands=5, missing=[('lig1', 'lig3')])
+	for j in range(5):
+		cols = ps.pair.columns(j, 2)
+		for i in range(5):
+			assert np.all(cols[i] == ps.pair[i, j, :, 2])
+
+def test_pose_matrix():
+	ps = pose_prediction(n_ligands=5, missing=[('lig1', 'lig3')])
+	iposes = np.array([1, 0, 3, 2, 4])
+	ligands = np.array([0, 1, 3, 4])
+	matrix = ps.pair.pose_matrix(ligands, iposes[ligands])
+	for a, i in enumerate(ligands):
+		for b, j in enumerate(ligands):
+			assert matrix[a, b] == ps.pair[i, j, iposes[i], iposes[j]]
+
+	for i in range(5):
+		rows = ps.pair.to_poses(i, iposes)
+		for j in range(5):
+			assert np.all(rows[j] == ps.pair[i, j, :, iposes[j]])
+
+@pytest.mark.parametrize('gc50', [float('inf'), -5.0])
+def test_subproblem(gc50):
+	ligands, raw, stats, features = random_problem(n_ligands=5, missing=[('lig1', 'lig3')])
+	ps = PosePrediction(ligands, raw, stats, ['lig0'], features, 100, 1.0, gc50)
+	sub = ps.subproblem(['lig3', 'lig1', 'lig4'], xtal={'lig4'})
+
+	ligands, raw, stats, features = random_problem(n_ligands=5, missing=[('lig1', 'lig3')])
+	expected = PosePrediction(['lig1', 'lig3', 'lig4'], raw, stats, {'lig4'},
+	                          features, ps.max_poses, 1.0, gc50)
+
+	assert sub.ligands == expected.ligands
+	assert sub.single == pytest.approx(expected.single)
+	for i in range(3):
+		for j in range(3):
+			assert np.all(sub.pair.block(i, j) == expected.pair.block(i, j))
+	assert sub.max_posterior(100, 5) == expected.max_posterior(100, 5)
+	assert np.all(ps.single[0, :ps.n_poses[0]] == ps.single[0, 0])
+
+def test_configure():
+	ligands, raw, stats, features = random_problem(missing=[('lig0', 'lig2')])
+	ps = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'))
+	sweep = ps.configure(['contact'], 2.0, -5.0)
+
+	ligands, raw, stats, features = random_problem(missing=[('lig0', 'lig2')])
+	expected = PosePrediction(ligands, raw, stats, [], ['contact'], 100, 2.0, -5.0)
+
+	assert sweep.single == pytest.approx(expected.single)
+	for i in range(len(ligands)):
+		for j in range(len(ligands)):
+			assert sweep.pair.block(i, j) == pytest.approx(expected.pair.block(i, j), abs=1e-5)
+	assert ps.configure().pair.blocks == pytest.approx(ps.pair.blocks, abs=1e-5)
+	assert ps.alpha == 1.0 and ps.features == features
+
+def test_add_ligands(tmp_path):
+	ligands, raw, stats, features = random_problem(n_ligands=6, missing=[('lig1', 'lig4')])
+	expected = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'))
+
+	ligands, raw, stats, features = random_problem(n_ligands=6, missing=[('lig1', 'lig4')])
+	old = ['lig1', 'lig3', 'lig5']
+	ps = PosePrediction(old, raw, stats, [], features, 100, 1.0, float('inf'))
+	ps.max_posterior(100, 5)
+	ps.write(str(tmp_path / 'state.pkl'))
+	ps = PosePrediction.read(str(tmp_path / 'state.pkl'))
+	assert ps.raw is None
+
+	# Only the new pairs, keyed in the opposite order for some.
+	new = {'gscore': raw['gscore']}
+	for feature in features:
+		new[feature] = {pair: x.T if pair[0] in old else x
+		                for pair, x in raw[feature].items()
+		                if pair[0] not in old or pair[1] not in old}
+		new[feature] = {(pair[::-1] if pair[0] in old else pair): x
+		                for pair, x in new[feature].items()}
+	ps.add_ligands(['lig0', 'lig2', 'lig4'], new)
+
+	index = [ps.ligand_index[ligand] for ligand in ligands]
+	assert ps.single[index] == pytest.approx(expected.single)
+	for i in range(6):
+		for j in range(6):
+			assert ps.pair.block(index[i], index[j]) == pytest.approx(
+			       expected.pair.block(i, j), abs=1e-5)
+	assert ps.max_posterior(100, 20, warm_start=True) == expected.max_posterior(100, 20)
+	assert np.all(ps.best_poses[index] == expected.best_poses)
+
+def test_optimize_local_optimum():
+	ps = pose_prediction(n_ligands=6, n_poses=6, seed=3)
+	np.random.seed(0)
+	poses = ps.optimize_poses({lig: 0 for lig in ps.ligands}, 100)
+	score = ps.log_posterior(poses)
+	for lig in ps.ligands:
+		for pose in range(ps.max_poses):
+			_poses = dict(poses)
+			_poses[lig] = pose
+			assert ps.log_posterior(_poses) <= score + 1e-4
+
+def test_max_posterior_global():
+	ps = pose_prediction(n_ligands=3, n_poses=4, seed=1)
+	best = max(((a, b, c) for a in range(4) for b in range(4) for c in range(4)),
+	           key=lambda p: ps.log_posterior(dict(zip(ps.ligands, p))))
+	poses = ps.max_posterior(100, 20)
+	assert tuple(poses[lig] for lig in ps.ligands) == best
+
+def test_max_posterior_processes():
+	ps = pose_prediction(n_ligands=8, n_poses=10, seed=2)
+	serial = ps.max_posterior(100, 12, processes=1, seed=5)
+	parallel = ps.max_posterior(100, 12, processes=3, seed=5)
+	assert serial == parallel
+
+def test_max_posterior_processes_gc50():
+	ps = pose_prediction(gc50=-5.0, n_ligands=4, n_poses=4, seed=2)
+	serial = ps.max_posterior(100, 4, processes=1, seed=1)
+	parallel = ps.max_posterior(100, 4, processes=2, seed=1)
+	assert serial == parallel
+
+def test_optimize_batch():
+	ps = pose_prediction(n_ligands=6, n_poses=6, seed=3)
+	iposes = np.random.RandomState(0).randint(6, size=(5, 6))
+	iposes, iterations = ps.optimize_poses_batch(iposes, 100, np.random.RandomState(1))
+	assert np.all(iterations >= 1)
+	for _iposes in iposes:
+		poses = dict(zip(ps.ligands, _iposes))
+		score = ps.log_posterior(poses)
+		for lig in ps.ligands:
+			for pose in range(ps.max_poses):
+				_poses = dict(poses)
+				_poses[lig] = pose
+				assert ps.log_posterior(_poses) <= score + 1e-4
+
+def test_max_posterior_batch():
+	ps = pose_prediction(n_ligands=8, n_poses=10, seed=2)
+	serial = ps.max_posterior(100, 12, processes=1, seed=5, batch_size=5)
+	parallel = ps.max_posterior(100, 12, processes=2, seed=5, batch_size=5)
+	assert serial == parallel
+	assert ps.log_posterior(serial) == pytest.approx(
+	           ps.log_posterior(ps.max_posterior(100, 12, seed=5)))
+
+def test_max_posterior_early_stopping(tmp_path):
+	ps = pose_prediction(n_ligands=5, n_poses=5, seed=2)
+	best = ps.max_posterior(100, 100)
+	assert len(ps.restart_log) == 100
+
+	log = str(tmp_path / 'restarts.csv')
+	assert ps.max_posterior(100, 100, rediscoveries=2, log=log) == best
+	n_restarts = len(ps.restart_log)
+	assert n_restarts < 100
+	assert ps.max_posterior(100, 100, processes=2, rediscoveries=2) == best
+	assert len(ps.restart_log) == n_restarts
+
+	log = pd.read_csv(log)
+	assert list(log['run']) == list(range(n_restarts))
+	assert np.all(log['iterations'] >= 1)
+	assert log['best_score'].iloc[-1] == pytest.approx(ps.log_posterior(best))
+
+	ps.max_posterior(100, 100, stop_probability=0.5)
+	assert 10 <= len(ps.restart_log) < 100
+
+	# Restarts that all agree only stop once there are min_restarts of them.
+	same = [[(np.zeros(5, dtype=int), 1.0, 1, 0.0)]] * 20
+	ps._best_restart(iter(same), stop_probability=0.05)
+	assert len(ps.restart_log) == 10
+	ps._best_restart(iter(same), stop_probability=0.05, min_restarts=3)
+	assert len(ps.restart_log) == 3
+
+	log = str(tmp_path / 'max_product.csv')
+	ps.max_posterior(100, 100, solver='max-product', log=log)
+	log = pd.read_csv(log)
+	assert len(log) == 1
+	assert log['score'].iloc[0] == pytest.approx(log['best_score'].iloc[0])
+
+def test_eliminate_dead_ends():
+	ligands, raw, stats, features = random_problem(n_ligands=4, n_poses=5, seed=4)
+	for i, lig in enumerate(ligands):
+		raw['gscore'][lig] = np.sort(-np.arange(len(raw['gscore'][lig]))**2 - i)
+	ps = PosePrediction(ligands, raw, stats, [], features, 100, 1.0, float('inf'))
+
+	shapes = [range(n) for n in ps.n_poses]
+	best = max(np.array(np.meshgrid(*shapes)).reshape(len(ligands), -1).T,
+	           key=lambda p: ps.log_posterior(dict(zip(ligands, p))))
+	best = dict(zip(ligands, best))
+
+	eliminated = ps.eliminate_dead_ends()
+	assert sum(eliminated.values()) > 0
+	assert all(ps.n_poses[i] + eliminated[lig] == len(raw['gscore'][lig])
+	           for i, lig in enumerate(ligands))
+	assert ps.max_posterior(100, 10) == best
+	assert set(ps.get_poses_prob(best)) == set(ligands)
+
+@pytest.mark.parametrize('solver', ['max-product', 'trws'])
+def test_message_passing_solvers(solver):
+	ps = pose_prediction(n_ligands=4, n_poses=4, seed=5)
+	shapes = [range(n) for n in ps.n_poses]
+	scores = [ps.log_posterior(dict(zip(ps.ligands, p)))
+	          for p in np.array(np.meshgrid(*shapes)).reshape(len(ps.ligands), -1).T]
+
+	poses = ps.max_posterior(100, 1, solver=solver)
+	assert ps.log_posterior(poses) <= max(scores) + 1e-6
+	assert ps.bound >= max(scores) - 1e-4
+
+def test_max_product_two_ligands():
+	ps = pose_prediction(n_ligands=2, n_poses=6, seed=6)
+	best = max(((a, b) for a in range(ps.n_poses[0]) for b in range(ps.n_poses[1])),
+	           key=lambda p: ps.log_posterior(dict(zip(ps.ligands, p))))
+	poses = ps.max_posterior(100, 1, solver='max-product')
+	assert tuple(poses[lig] for lig in ps.ligands) == best
+	assert ps.bound == pytest.approx(ps.log_posterior(poses), abs=1e-4)
+
+def message_passing_prob(ps, single, pair, corr, max_iter=100, tol=0.0001):
+	q_old = np.vstack([single, np.zeros(single.shape)]).T
+	q_old = np.exp(q_old)
+	q_old /= q_old.sum(axis=1, keepdims=True)
+	for _ in range(max_iter):
+		q = np.vstack([single, np.zeros(single.shape)]).T
+		C = ps.correlations(corr, q_old)
+		q[:, 0] += np.sum(C*np.log(q_old[:, 0]*np.exp(pair) + q_old[:, 1]), axis=1)
+		q = np.exp(q)
+		q /= q.sum(axis=1, keepdims=True)
+		if np.max(np.abs(q - q_old)) < tol:
+			break
+		q_old = q
+	return q
+
+def test_message_passing():
+	ps = pose_prediction(gc50=-5.0)
+	rng = np.random.RandomState(0)
+	single = rng.randn(6)
+	pair = rng.randn(6, 6)
+	pair = pair + pair.T
+	np.fill_diagonal(pair, 0)
+	corr = np.ones((6, 6))
+
+	expected = message_passing_prob(ps, single, pair, corr)
+	assert ps.message_passing(single, pair, corr) == pytest.approx(expected, abs=1e-6)
+	assert ps.message_passing(single, pair, corr, damping=0.5) == pytest.approx(expected, abs=1e-3)
+
+def test_message_passing_large_energies():
+	ps = pose_prediction(gc50=-5.0)
+	single = np.array([1.0, -2.0, 0.5])
+	pair = np.array([[0.0, 1000.0, -1000.0],
+	                 [1000.0, 0.0, 800.0],
+	                 [-1000.0, 800.0, 0.0]])
+	q = ps.message_passing(single, pair, np.ones((3, 3)))
+	assert np.all(np.isfinite(q))
+	assert q.sum(axis=1) == pytest.approx(1.0)
+
+def test_message_passing_warm_start():
+	ps = pose_prediction(gc50=-5.0, n_ligands=5)
+	iposes = np.array([1, 0, 2, 0, 1])
+	ligands = np.array([0, 1, 2, 4])
+	ps.get_prob(iposes, ligands, warm_start=True)
+	assert np.isnan(ps.q[3])
+
+	ps.message_passing_iterations = 0
+	ps.get_prob(iposes, ligands, warm_start=True)
+	assert ps.message_passing_iterations == 1
+
+	iposes[2] = 3
+	ps.message_passing_iterations = 0
+	cold = ps.get_prob(iposes, ligands)
+	cold_iterations = ps.message_passing_iterations
+
+	ps.message_passing_iterations = 0
+	warm = ps.get_prob(iposes, ligands, warm_start=True)
+	assert warm == pytest.approx(cold, abs=1e-3)
+	assert ps.message_passing_iterations < cold_iterations
+	assert ps.q[ligands] == pytest.approx(warm[:, 0])
@@ -0,0 +1,75 @@
+"""
+Tests for screening.
+"""
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from score.screen import screen, best_poses, write_best_poses
+from score.density_estimate import DensityEstimate
+
+def stats(seed=0):
+	rng = np.random.RandomState(seed)
+	_stats = {}
+	for feature in ['hbond', 'contact']:
+		native = DensityEstimate(domain = (0, 1), sd = 0.03)
+		native.fit(rng.beta(2, 5, size=200))
+		reference = DensityEstimate(domain = (0, 1), sd = 0.03)
+		reference.fit(rng.rand(200))
+		_stats[feature] = {'native': native, 'reference': reference}
+	return _stats
+
+def test_screen_chunked(tmp_path):
+	rng = np.random.RandomState(0)
+	_stats = stats()
+	single = -10*rng.rand(1003)
+	raw = {feature: rng.rand(1003, 7) for feature in _stats}
+	weights = rng.rand(7)
+
+	pair = sum(np.log(_stats[feature]['native'](raw[feature]))
+	           - np.log(_stats[feature]['reference'](raw[feature]))
+	           for feature in raw)
+	alpha = 1.5 / (0.5 * 7 / (1 + 6*0.5))
+	expected = (pair*weights.reshape(1, -1)).mean(axis=1)/alpha - single
+
+	for feature in raw:
+		np.save(str(tmp_path / feature), raw[feature])
+	np.save(str(tmp_path / 'gscore'), single)
+	mapped = {feature: np.load(str(tmp_path / (feature + '.npy')), mmap_mode='r')
+	          for feature in raw}
+	single = np.load(str(tmp_path / 'gscore.npy'), mmap_mode='r')
+
+	for chunk_size in [100, 1003, 5000]:
+		assert screen(single, mapped, _stats, 1.5, weights, chunk_size) \
+		       == pytest.approx(expected)
+	assert screen(single, mapped, _stats, 1.5, chunk_size=64) \
+	       == pytest.approx(screen(single, raw, _stats, 1.5, np.ones(7)))
+
+def test_best_poses():
+	titles = np.array(['a', 'b', 'a', 'c', 'b', 'c', 'd'])
+	scores = np.array([-5.0, -7.0, -6.0, -1.0, -2.0, -3.0, -4.0])
+
+	assert list(best_poses(titles, scores)) == [1, 2, 6, 5]
+	assert list(best_poses(titles, scores, top_k=2)) == [1, 2]
+	assert list(best_poses(titles, scores, descending=True)) == [3, 4, 6, 0]
+	assert list(best_poses(titles, scores, top_k=3, descending=True)) == [3, 4, 6]
+
+	with pytest.raises(AssertionError):
+		best_poses(titles[:-1], scores)
+
+def test_write_best_poses(tmp_path):
+	titles = ['a', 'b', 'a', 'c', 'b', 'c']
+	glide = np.array([-5.0, -7.0, -6.0, -1.0, -2.0, -3.0])
+	combind = np.array([1.0, 0.5, 3.0, 2.0, 4.0, -1.0])
+	write_best_poses(str(tmp_path / 'scores'), titles, glide, combind, top_k=2)
+
+	ranked = pd.read_csv(str(tmp_path / 'scores_combind.csv'))
+	assert list(ranked['ID']) == ['b', 'a']
+	assert list(ranked['COMBIND']) == [4.0, 3.0]
+	assert list(ranked['GLIDE']) == [-2.0, -6.0]
+
+	ranked = pd.read_csv(str(tmp_path / 'scores_glide.csv'))
+	assert list(ranked['ID']) == ['b', 'a']
+	assert list(ranked['GLIDE']) == [-7.0, -6.0]
+	assert list(ranked['COMBIND']) == [0.5, 3.0]
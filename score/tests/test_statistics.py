@@ -0,0 +1,118 @@
+"""
+Tests for training statistics.
+"""
+
+import pytest
+import os
+import numpy as np
+
+from score.statistics import (write_pair_table, read_pair_table, read_stats,
+                              merge_stats, train_protein, train_stats)
+from score.density_estimate import DensityEstimate
+from score.log_ratio import LogRatio
+from features.features import Features
+
+@pytest.fixture(autouse=True)
+def combindhome(tmp_path, monkeypatch):
+	monkeypatch.setenv('COMBINDHOME', str(tmp_path))
+
+def make_protein(root, n_poses, seed=0):
+	rng = np.random.RandomState(seed)
+	features = Features(root)
+	pvs = []
+	for i, n in enumerate(n_poses):
+		name = 'lig{}-to-grid'.format(i)
+		pv = '{}/docking/{}/{}_pv.maegz'.format(root, name, name)
+		os.makedirs(os.path.dirname(pv))
+		open(pv, 'w').close()
+		np.save(features.path('gscore', pv=pv), -10*rng.rand(n))
+		np.save(features.path('rmsd', pv=pv), 4*rng.rand(n))
+		pvs += [pv]
+
+	os.makedirs(root + '/shape')
+	for i, pv1 in enumerate(pvs):
+		for j in range(i+1, len(pvs)):
+			np.save(features.path('shape', pv=pv1, pv2=pvs[j]),
+			        rng.rand(n_poses[i], n_poses[j]))
+	return pvs
+
+def table(n, seed=0):
+	rng = np.random.RandomState(seed)
+	return {'ligand1': rng.randint(2, size=n).astype(np.int32),
+	        'ligand2': rng.randint(2, size=n).astype(np.int32),
+	        'rank1': np.arange(n),
+	        'rank2': np.arange(n),
+	        'hbond': rng.rand(n)}
+
+def test_write_pair_table(tmp_path):
+	root = str(tmp_path / 'pairs')
+	tables = [table(5, seed) for seed in range(4)]
+	write_pair_table(root, ['A', 'B'], tables, chunksize=5)
+	df = list(read_pair_table(root))
+	assert len(df) == 4
+	assert sum(map(len, df)) == 20
+
+	tables = [table(5, 10)]
+	write_pair_table(root, ['C', 'D'], tables, chunksize=5)
+	df = list(read_pair_table(root, protein='P'))
+	assert len(df) == 1
+	df = df[0]
+	assert len(df) == 5
+	assert (df['protein'] == 'P').all()
+	assert np.allclose(df['hbond'], tables[0]['hbond'])
+	assert list(df['ligand1']) == [['C', 'D'][i] for i in tables[0]['ligand1']]
+	assert list(df['ligand2']) == [['C', 'D'][i] for i in tables[0]['ligand2']]
+	assert not (tmp_path / 'pairs.tmp').exists()
+
+def test_train_protein(tmp_path):
+	root = str(tmp_path / 'P')
+	pvs = make_protein(root, [3, 4, 5])
+	pairs_root, stats_root = str(tmp_path / 'pairs'), str(tmp_path / 'stats')
+	os.makedirs(pairs_root)
+	os.makedirs(stats_root)
+	fname = stats_root + '/P/reference_shape.de'
+
+	assert train_protein(root, pairs_root, stats_root, ['shape'])
+	assert sum(map(len, read_pair_table(pairs_root + '/P'))) == 3*4 + 3*5 + 4*5
+	reference = DensityEstimate.read(fname).fx
+
+	assert not train_protein(root, pairs_root, stats_root, ['shape'])
+
+	features = Features(root)
+	shape = features.path('shape', pv=pvs[0], pv2=pvs[1])
+	np.save(shape, np.zeros((3, 4)))
+	stat = os.stat(shape)
+	os.utime(shape, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	assert train_protein(root, pairs_root, stats_root, ['shape'])
+	assert not np.allclose(DensityEstimate.read(fname).fx, reference)
+	assert not train_protein(root, pairs_root, stats_root, ['shape'])
+
+def test_train_stats(tmp_path):
+	roots = [str(tmp_path / protein) for protein in ['P', 'Q', 'R']]
+	for seed, root in enumerate(roots):
+		make_protein(root, [3, 4, 5], seed)
+	pairs_root, stats_root = str(tmp_path / 'pairs'), str(tmp_path / 'stats')
+	out_root = str(tmp_path / 'out')
+
+	train_stats(roots, pairs_root, stats_root, out_root, ['shape'],
+	            leave_one_out=True)
+
+	subsets = {out_root: ['P', 'Q', 'R'],
+	           out_root + '/without-P': ['Q', 'R'],
+	           out_root + '/without-Q': ['P', 'R'],
+	           out_root + '/without-R': ['P', 'Q']}
+	for subset, proteins in subsets.items():
+		merged = str(tmp_path / 'merged_{}_{}.txt')
+		merge_stats(proteins, stats_root, merged, ['shape'])
+		stats = read_stats(subset, ['shape'], compiled=False)['shape']
+		for dist in ['native', 'reference']:
+			expected = DensityEstimate.read(merged.format(dist, 'shape'))
+			assert np.allclose(stats[dist].x, expected.x)
+			assert np.allclose(stats[dist].fx, expected.fx)
+			assert stats[dist].n_samples == expected.n_samples
+
+		log_ratio = read_stats(subset, ['shape'])['shape']
+		assert isinstance(log_ratio, LogRatio)
+		x = np.linspace(0, 1, 11)
+		assert np.allclose(log_ratio(x), np.log(stats['native'](x))
+		                                 - np.log(stats['reference'](x)))
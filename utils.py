@@ -3,10 +3,10 @@ import os
 import numpy as np
 from schrodinger.structure import StructureReader, StructureWriter
 
-def np_load(fname, halt=True, delete=False):
+def np_load(fname, halt=True, delete=False, mmap_mode=None):
     fname = os.path.abspath(fname)
     try:
-        return np.load(fname)
+        return np.load(fname, mmap_mode=mmap_mode)
     except ValueError as e:
         m = 'Cannot load file containing pickled data when allow_pickle=False'
         if m in str(e):